@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+"""
+Name: Cortisol_Benchmark.py
+
+Times each stage of Cortisol_PreProcessing.py on synthetic data
+so that you can see how it scales with the number of subjects
+(and whether a change has made it faster or slower).
+
+The synthetic data looks just like the SPSS export: the same
+column names (bl_d1wakecortisol, including the bl_d130comment
+typo), comments, minawake, medication names and the 999 and 99
+missing data codes. The medication lists and subject lists are
+made up to go with it and every selection criterion is switched
+on so that every stage has some work to do.
+
+The results for each number of subjects are added to the end of
+a results file (one JSON record per line) together with the git
+commit they were run on so you can compare them across commits.
+Each number of subjects is run in its own process so the peak
+memory is just for that number of subjects.
+
+USAGE: Cortisol_Benchmark.py <benchmark_dir> [options]
+    <benchmark_dir> is where the synthetic data (and by default
+                    the results) are kept. The data is only
+                    made once for each number of subjects.
+    Options:
+        --sizes=1000,10000,100000,1000000
+                    the numbers of subjects to try (these are
+                    the defaults)
+        --results=<filename>
+                    where to keep the results (default is
+                    <benchmark_dir>/benchmark_results.jsonl)
+        --figures   also time drawing the figures
+        --sweep     also time the criteria sweep
+        --compare   compare the results with the last ones
+                    from a different commit
+"""
+#====================================================================
+# IMPORTS
+import numpy as np
+import sys
+import os
+import json
+import time
+import platform
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+
+# Cortisol_PreProcessing.py lives in the same directory as this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import Cortisol_PreProcessing as cpp
+#====================================================================
+
+#====================================================================
+# FUNCTIONS
+#====================================================================
+def usage():
+    print __doc__[__doc__.index('USAGE'):]
+
+def define_medications():
+    '''
+    The medication entries (and how often they turn up) in the
+    synthetic data. Lots of subjects have exactly the same entry
+    (not least all the empty ones) just like the real data.
+    '''
+    medications = [ ( '', 0.55 ),
+                    ( 'none', 0.1 ),
+                    ( 'Fluoxetine 20mg', 0.05 ),
+                    ( '"sertraline, ibuprofen"', 0.05 ),
+                    ( 'paracetamol', 0.05 ),
+                    ( 'Inhaler; salbutamol', 0.05 ),
+                    ( 'fluoxetine.', 0.05 ),
+                    ( 'oral contraceptive pill', 0.05 ),
+                    ( 'Citalopram_10mg', 0.05 ) ]
+    return medications
+#--------------------------------------------------------------------
+
+def define_spss_columns():
+    '''
+    The column names just as they come out of SPSS
+    (typos and all)
+    '''
+    names = [ 'ID' ]
+    for day in [ 1, 2 ]:
+        names += [ 'bl_d{day}wakecortisol'.format(day=day),
+                    'bl_d{day}30mcortisol'.format(day=day),
+                    'bl_d{day}evecortisol'.format(day=day),
+                    'bl_d{day}wakecomment'.format(day=day),
+                    'bl_d{day}30mcomment'.format(day=day),
+                    'bl_d{day}evecomment'.format(day=day),
+                    'bl_d{day}minawake'.format(day=day) ]
+    names += [ 'bl_med_name' ]
+
+    # This one really is spelled like this in the export
+    names[names.index('bl_d130mcomment')] = 'bl_d130comment'
+
+    return names
+#--------------------------------------------------------------------
+
+def make_cortisol_column(random_state, n_subs, sample):
+    '''
+    Cortisol values (as text) with the missing data codes:
+        8% empty, 2% 99 (the typo), 2% 999, 5% too high (>3)
+    Evening values are lower than morning ones
+    '''
+    low = 0.05 if sample == 'eve' else 0.3
+    values = np.char.mod('%.3f', random_state.rand(n_subs) * 1.5 + low)
+
+    codes = random_state.rand(n_subs)
+    values[codes < 0.17] = np.char.mod('%.3f', random_state.rand(n_subs) * 2 + 3)[codes < 0.17]
+    values[codes < 0.12] = '999'
+    values[codes < 0.10] = '99'
+    values[codes < 0.08] = ''
+
+    return values
+#--------------------------------------------------------------------
+
+def make_comment_column(random_state, n_subs):
+    '''
+    Mostly '1000' (good samples) with a few other codes and blanks
+    '''
+    values = np.array([ '1000' ] * n_subs, dtype='S4')
+    codes = random_state.rand(n_subs)
+    values[codes < 0.2] = '2000'
+    values[codes < 0.1] = 'late'
+    values[codes < 0.03] = ''
+    return values
+#--------------------------------------------------------------------
+
+def make_minawake_column(random_state, n_subs):
+    '''
+    Minutes after waking - left empty if the sample was "perfect"
+    '''
+    values = np.char.mod('%d', random_state.randint(0, 40, n_subs))
+    values[random_state.rand(n_subs) < 0.3] = ''
+    return values
+#--------------------------------------------------------------------
+
+def make_medication_column(random_state, n_subs):
+    medications = define_medications()
+    entries = np.array([ medication for medication, p in medications ])
+    p = np.array([ p for medication, p in medications ])
+    return entries[random_state.choice(len(entries), n_subs, p=p / p.sum())]
+#--------------------------------------------------------------------
+
+def make_synthetic_data(data_filename, n_subs, seed=0, chunk_size=10000):
+    '''
+    Write a TAB delimited file that looks like the SPSS export
+    with n_subs subjects
+    '''
+    random_state = np.random.RandomState(seed)
+    names = define_spss_columns()
+
+    columns = []
+    for name in names:
+        if name == 'ID':
+            columns.append(np.char.mod('%d', np.arange(n_subs) + 1000))
+        elif name.endswith('cortisol'):
+            columns.append(make_cortisol_column(random_state, n_subs, name[5:(-8)]))
+        elif name.endswith('comment'):
+            columns.append(make_comment_column(random_state, n_subs))
+        elif name.endswith('minawake'):
+            columns.append(make_minawake_column(random_state, n_subs))
+        else:
+            columns.append(make_medication_column(random_state, n_subs))
+
+    # Write to a temporary file and move it into place so a half
+    # written data file is never used
+    temp_filename = data_filename + '.{pid}.tmp'.format(pid=os.getpid())
+    # (SPSS doesn't put quotes around anything so neither do we)
+    with open(temp_filename, 'wb') as f:
+        f.write('\t'.join(names) + '\n')
+        for start in xrange(0, n_subs, chunk_size):
+            rows = zip(*[ column[start:start+chunk_size].tolist() for column in columns ])
+            f.write(''.join([ '\t'.join(row) + '\n' for row in rows ]))
+    os.rename(temp_filename, data_filename)
+#--------------------------------------------------------------------
+
+def make_synthetic_lists(benchmark_dir, n_subs, seed=0):
+    '''
+    Write the medication lists and the include and exclude subject
+    lists that go with the synthetic data
+    RETURNS:    criteria (dictionary of selection criteria answers
+                            that switches everything on)
+    '''
+    random_state = np.random.RandomState(seed + 1)
+
+    medlist_file = os.path.join(benchmark_dir, 'medlist.txt')
+    with open(medlist_file, 'w') as f:
+        f.write('FLUOXETINE\nsertraline \nCitalopram\n')
+
+    medlist_special_cases_file = os.path.join(benchmark_dir, 'medlist_special_cases.txt')
+    with open(medlist_special_cases_file, 'w') as f:
+        f.write('"ORAL CONTRACEPTIVE PILL"\n')
+
+    # Include 90% of the subjects and exclude 1% of those
+    sub_ids = np.arange(n_subs) + 1000
+    include_subs_list = os.path.join(benchmark_dir, 'include_subs_{n}.txt'.format(n=n_subs))
+    np.savetxt(include_subs_list, sub_ids[random_state.rand(n_subs) < 0.9], fmt='%d')
+    exclude_subs_list = os.path.join(benchmark_dir, 'exclude_subs_{n}.txt'.format(n=n_subs))
+    np.savetxt(exclude_subs_list, sub_ids[random_state.rand(n_subs) < 0.01], fmt='%d')
+
+    criteria = {    'cort_lt_3': True,
+                    'comment_1000': True,
+                    'minawake_lt10': True,
+                    'require_whole_day': True,
+                    'need_2_am': True,
+                    'excl_neg_CAR': True,
+                    'excl_med': True,
+                    'medlist_file': medlist_file,
+                    'medlist_special_cases_file': medlist_special_cases_file,
+                    'filter_subs': True,
+                    'include_subs_list': include_subs_list,
+                    'exclude_subs_list': exclude_subs_list,
+                    'criteria_title': 'BENCHMARK: {n} SUBJECTS'.format(n=n_subs) }
+
+    return criteria
+#--------------------------------------------------------------------
+
+def define_commit():
+    '''
+    The git commit that Cortisol_PreProcessing.py is on (with
+    -dirty on the end if it's been changed since) or None if
+    we can't tell
+    '''
+    try:
+        commit = subprocess.check_output([ 'git', 'describe', '--always', '--dirty' ],
+                                            cwd=os.path.dirname(os.path.abspath(cpp.__file__)),
+                                            stderr=open(os.devnull, 'w'))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.strip()
+#--------------------------------------------------------------------
+
+def run_benchmark(benchmark_dir, n_subs, results_filename, figures=False, sweep=False):
+    '''
+    Time each stage of the pipeline for n_subs subjects and add
+    the results to the end of results_filename
+    '''
+    data_filename = os.path.join(benchmark_dir, 'synthetic_{n}.txt'.format(n=n_subs))
+    if not os.path.isfile(data_filename):
+        print '  Making {n} subjects of synthetic data'.format(n=n_subs)
+        make_synthetic_data(data_filename, n_subs)
+    criteria = make_synthetic_lists(benchmark_dir, n_subs)
+
+    output_basename = os.path.join(benchmark_dir, 'output_{n}'.format(n=n_subs))
+    profiler = cpp.StageProfiler()
+
+    # Reading the text file from scratch, then making the cache
+    # and then reading it back from the cache
+    cache_dir = os.path.join(benchmark_dir, '.cache')
+    for filename in os.listdir(cache_dir) if os.path.isdir(cache_dir) else []:
+        if filename.startswith(os.path.basename(data_filename) + '.'):
+            os.remove(os.path.join(cache_dir, filename))
+    profiler.run('read_data_file', cpp.read_data_file, data_filename)
+    profiler.run('import_data_cold_cache', cpp.import_data, data_filename)
+    data, layout = profiler.run('import_data', cpp.import_data, data_filename)
+
+    if sweep:
+        profiler.run('criteria_sweep', cpp.criteria_sweep, data, layout, criteria,
+                        output_basename + '_sweep.txt')
+
+    table = cpp.process(data, criteria, layout, profiler)
+
+    if figures:
+        profiler.run('data_report', cpp.data_report, table, criteria['criteria_title'],
+                        output_basename + '.png')
+    else:
+        for occasion in layout['occasions']:
+            profiler.run('collect_report_data', cpp.collect_report_data, table, occasion)
+
+    profiler.run('data_save', cpp.data_save, table, output_basename + '.txt')
+
+    # Throughput is always in subjects (that went into the pipeline) per second
+    for stage in profiler.stages:
+        stage['subjects_per_second'] = n_subs / max(stage['wall_time'], 1e-9)
+
+    record = OrderedDict()
+    record['commit'] = define_commit()
+    record['date'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    record['host'] = platform.node()
+    record['python'] = platform.python_version()
+    record['numpy'] = np.__version__
+    record['n_subs'] = n_subs
+    record['stages'] = profiler.stages
+    record['total_wall_time'] = sum([ stage['wall_time'] for stage in profiler.stages ])
+    record['process_peak_rss_mb'] = cpp.measure_peak_rss()
+
+    with open(results_filename, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+    print_record(record)
+#--------------------------------------------------------------------
+
+def print_record(record):
+    print '  {n} subjects (commit {commit}), peak memory {rss} MB'.format(n=record['n_subs'],
+                                                                        commit=record['commit'],
+                                                                        rss=format_mb(record['process_peak_rss_mb']))
+    for stage in record['stages']:
+        print '    {name:<30} {time:>10.4f} s {rate:>14.0f} subs/s {peak:>10} MB'.format(name=stage['name'],
+                                                                        time=stage['wall_time'],
+                                                                        rate=stage['subjects_per_second'],
+                                                                        peak=format_mb(stage.get('stage_peak_rss_mb')))
+#--------------------------------------------------------------------
+
+def format_mb(mb):
+    '''
+    A memory number for printing ('-' if we don't know it)
+    '''
+    if mb is None:
+        return '-'
+    return '{mb:.1f}'.format(mb=mb)
+#--------------------------------------------------------------------
+
+def read_results(results_filename):
+    '''
+    All the results saved so far (oldest first)
+    '''
+    if not os.path.isfile(results_filename):
+        return []
+    with open(results_filename) as f:
+        return [ json.loads(line) for line in f if line.strip() ]
+#--------------------------------------------------------------------
+
+def compare_results(results, n_previous):
+    '''
+    Compare the newest results (the last n_previous records) with
+    the most recent results for the same number of subjects from
+    a different commit
+    '''
+    new_records = results[len(results)-n_previous:]
+    old_records = results[:len(results)-n_previous]
+
+    for record in new_records:
+        previous = [ old for old in old_records
+                        if old['n_subs'] == record['n_subs']
+                            and not old['commit'] == record['commit'] ]
+        if not previous:
+            print '  Nothing to compare {n} subjects to'.format(n=record['n_subs'])
+            continue
+        previous = previous[-1]
+
+        print '  {n} subjects: {new} vs {old}'.format(n=record['n_subs'],
+                                                        new=record['commit'],
+                                                        old=previous['commit'])
+        previous_times = dict([ (stage['name'], stage['wall_time']) for stage in previous['stages'] ])
+        for stage in record['stages']:
+            if not stage['name'] in previous_times:
+                continue
+            ratio = stage['wall_time'] / max(previous_times[stage['name']], 1e-9)
+            print '    {name:<30} {old:>10.4f} s -> {new:>10.4f} s ({ratio:.2f}x)'.format(name=stage['name'],
+                                                                        old=previous_times[stage['name']],
+                                                                        new=stage['wall_time'],
+                                                                        ratio=ratio)
+#--------------------------------------------------------------------
+
+def main(argv):
+    options = [ arg for arg in argv[1:] if arg.startswith('--') ]
+    arguments = [ arg for arg in argv[1:] if not arg.startswith('--') ]
+    try:
+        benchmark_dir = arguments[0]
+    except IndexError:
+        usage()
+        sys.exit()
+
+    sizes = [ 1000, 10000, 100000, 1000000 ]
+    results_filename = os.path.join(benchmark_dir, 'benchmark_results.jsonl')
+    for option in options:
+        if option.startswith('--sizes='):
+            sizes = [ int(size) for size in option[len('--sizes='):].split(',') ]
+        elif option.startswith('--results='):
+            results_filename = option[len('--results='):]
+
+    if not os.path.isdir(benchmark_dir):
+        os.makedirs(benchmark_dir)
+
+    # Run each size in its own process so that the peak memory is
+    # just for that size
+    n_before = len(read_results(results_filename))
+    for n_subs in sizes:
+        benchmark_process = multiprocessing.Process(target=run_benchmark,
+                                                    args=(benchmark_dir, n_subs, results_filename,
+                                                            '--figures' in options,
+                                                            '--sweep' in options))
+        benchmark_process.start()
+        benchmark_process.join()
+        if not benchmark_process.exitcode == 0:
+            print 'Something went wrong with {n} subjects'.format(n=n_subs)
+
+    if '--compare' in options:
+        results = read_results(results_filename)
+        compare_results(results, len(results) - n_before)
+#--------------------------------------------------------------------
+
+#====================================================================
+# MAIN CODE
+#====================================================================
+if __name__ == '__main__':
+    main(sys.argv)
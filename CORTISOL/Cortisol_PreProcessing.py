@@ -11,12 +11,45 @@ data across two days for waking, waking+30, evening measures of
 cortisol. It also calculates (and then averages) the cortisol
 awakening response, the maximum am value, daytime average and
 daytime range.
+The occasions (eg: bl), days and samples are all worked out from
+the {occasion}_d{day}_{sample}cortisol column names so follow up
+occasions (or extra days or samples) are dealt with in exactly
+the same way as the baseline data.
 
 The various selection criteria can be set in the
 Cortisol_SelectionCriteria.py file and is passed as an argument.
 
 The output is a tab delineated text file and a png file
-(with the same name but different endings)
+(with the same name but different endings). If you pass the
+--sidecar option the columns are also saved to a compressed
+numpy .npz file. If you pass the --no-figures option
+there won't be a png file. The --sweep option also makes
+a table of Ns for every possible combination of the selection
+criteria.
+
+Why each cortisol measure was (or wasn't) excluded is kept in one
+{occasion}_d{day}_{sample}cortisol_flags column per measure with a
+bit set for every selection criterion it failed (0 means it can
+be used). decode_flags turns these back into the criteria names
+and the --flags option saves a summary of them.
+
+If the data arrives in batches the --incremental option only
+processes the subjects who are new (or whose rows have changed)
+since the last incremental run and merges them with the results
+for everyone else (which are kept in <output>_state.npz).
+
+The --bootstrap option saves bootstrap confidence intervals for the
+mean of each averaged measure and for the reliability (correlation)
+between day 1 and day 2.
+
+The --profile option saves how long each stage took (and how much
+memory it used) to <output>_profile.json.
+
+You can also import this file and use it as a library, eg:
+    import Cortisol_PreProcessing as cpp
+    data, layout = cpp.import_data('IMPACT_Cortisol_data.txt')
+    criteria = cpp.read_selection_criteria('Cortisol_SelectionCriteria.py')
+    table = cpp.process(data, criteria)
 
 TO BE DONE:
     Filter by medication
@@ -29,18 +62,30 @@ import numpy as np
 import itertools as it
 import sys
 import os
-import matplotlib.pylab as plt
-import numpy.lib.recfunctions as rec
-from matplotlib.ticker import MaxNLocator
+import multiprocessing
 import platform
 import string
 import re
-
-sys.path.insert(0, '/work/imagingA/mrimpact/workspaces/CORTISOL/SCRIPTS')
-sys.path.insert(0, 'C:\\Users\\Kirstie\\Dropbox\\GitHub\\GENERAL_CODE')
-
-# Import Kirstie's personal scripts
-import MyCoolFunctions as mcf
+import operator
+import csv
+import hashlib
+import inspect
+import time
+import json
+import cProfile
+import warnings
+from collections import OrderedDict
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# The subject lists are read (and the data cached) the same way as
+# in RandomiseSetup.py (see SHARED/SubjectLists.py and SHARED/DataCache.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    os.pardir, 'SHARED'))
+from SubjectLists import read_subject_set
+from DataCache import load_cached_data
 #====================================================================
 
 #====================================================================
@@ -50,7 +95,8 @@ def usage():
     print ( 'USAGE: Cortisol_PreProcessing.py '
                 + ' <data_filename>'
                 + ' <selection_criteria_filename>'
-                + ' <output_filename>' )
+                + ' <output_filename>'
+                + ' [options]' )
     print ''
     print ( '\t<data_filename> is a TAB delineated file'
                 + ' containing the cortisol data' )
@@ -59,51 +105,108 @@ def usage():
                 + ' selection criteria' )
     print ( '\t<output_filename> is, as it says, the TAB'
                 + ' delineated output file')
+    print ( '\tOptions:' )
+    print ( '\t\t--sidecar also saves all the columns to a compressed'
+                + ' numpy .npz file next to the output file' )
+    print ( '\t\t--no-figures skips the png file (and never loads'
+                + ' matplotlib)' )
+    print ( '\t\t--sweep also saves a table of Ns for every combination'
+                + ' of the selection criteria to <output>_sweep.txt' )
+    print ( '\t\t--sweep-averages does the same and also saves the averaged'
+                + ' measures for every combination to <output>_sweep_averages.txt' )
+    print ( '\t\t--flags also saves the number of measures excluded by'
+                + ' each selection criterion to <output>_flags.txt' )
+    print ( '\t\t--incremental only processes the subjects who are new'
+                + ' or have changed since the last incremental run'
+                + ' (the results are kept in <output>_state.npz)' )
+    print ( '\t\t--profile saves the time, CPU time, peak memory and size'
+                + ' of the data for each stage to <output>_profile.json' )
+    print ( '\t\t--profile-stats does the same and also saves the cProfile'
+                + ' stats for each stage to <output>_profile_<stage>.prof' )
+    print ( '\t\t--bootstrap saves bootstrap confidence intervals (10000'
+                + ' resamples, or --bootstrap=N for N) for the mean and the day to'
+                + ' day reliability of each averaged measure to <output>_bootstrap.txt' )
+    print ( '\t\t--no-cache always reads the data file rather than'
+                + ' using the binary cache in the .cache directory next to it' )
     print ( '\tFor example:')
     print ('\t\t ./Cortisol_Preprocessing.py'
                 + ' IMPACT_Cortisol_data.txt'
                 + ' selection_criteria.py'
                 + ' cortisol_output_April2013.txt' )
                 
-def import_data(data_filename):
+def normalize_column_name(name):
     '''
-    Read in the data as a TAB separated file
-    Correct some bonkers naming typos
-    Define a couple of useful dictionaries
-    INPUT:      tab separated filename
-    RETURNS:    data (recarray)
-                measure_dict
-                minawake_dict
+    Correct some bonkers naming typos and tidy up the
+    column names from the SPSS export
     '''
-    data = np.genfromtxt(data_filename,
-                            names=True, dtype=None,
-                            delimiter='\t',
-                            filling_values = 999)
-
-    # Correct some bonkers naming typos:
-    names = list(data.dtype.names)
+    name = name.strip().replace(' ', '_')
 
-    names = [ name if not name == 'bl_d130comment'
-                        else 'bl_d130mcomment'
-                        for name in names ]
+    # (eg: bl_d130comment should be bl_d130mcomment)
+    name = re.sub('^([A-Za-z]+_d1)30comment$', r'\g<1>30mcomment', name)
 
     # Because I think it looks nicer insert an _ between
     # the day (eg: d1) and the time of measurement
-    for i, name in enumerate(names):
-        n_l = list(name)
-        if len(n_l) > 5:
-            if n_l[3] == 'd' and not n_l[5] == '_':
-                n_l.insert(5, '_')
-            name = ''.join(n_l)
-        names[i] = name
+    # (for every occasion, eg: bl_d1wake -> bl_d1_wake)
+    name = re.sub('^([A-Za-z]+_d[0-9])(?=[^_])', r'\1_', name)
 
-    data.dtype.names = names
+    return name
+#--------------------------------------------------------------------
+
+def define_column_dtype(name):
+    '''
+    The schema for the input data: work out what type of data
+    is in each (normalized) column from its name.
+    Returns None for columns we don't know about, in which case
+    the type is worked out from the data itself.
+    '''
+    if name == 'ID':
+        return int
+    elif name.endswith('cortisol'):
+        return float
+    elif name.endswith('minawake'):
+        return int
+    elif name.endswith('comment') or name == 'bl_med_name':
+        return str
+    else:
+        return None
+#--------------------------------------------------------------------
+
+def convert_column(name, values, dtype):
+    '''
+    Turn a list of strings from the text file into an array
+    of the right type and clean it up as we go
+    '''
+    values = np.array(values, dtype=str)
+
+    if dtype is str:
+        return values
+
+    # Missing numbers are filled in with 999
+    # (np.where makes sure the strings are long enough to fit it)
+    values = np.where(np.char.strip(values) == '', '999', values)
+
+    if dtype is None:
+        # Not in the schema so try ints, then floats, then give up
+        # and leave it as strings
+        for dtype in [ int, float, str ]:
+            try:
+                converted = values.astype(dtype)
+                break
+            except ValueError:
+                continue
+        if dtype is str:
+            return converted
+        values = converted
+    elif dtype is int:
+        try:
+            values = values.astype(int)
+        except ValueError:
+            values = values.astype(float).astype(int)
+    else:
+        values = values.astype(dtype)
 
     # There is a 99 typo. Lets fix that here:
-    for name in names:
-        x = data[name]
-        if not np.issubdtype(x.dtype, str):
-            x[x==99] = 999
+    values[values==99] = 999
 
     # As another little clean up thing, if there is a 999
     # in the 'bl_d{day}_minawake' column then replace that
@@ -111,275 +214,697 @@ def import_data(data_filename):
     # taken right away, because the data might really be missing
     # but this was entered in a pretty bonkers way such that
     # if the data is "perfect" then there is no entry!
-    mask = data['bl_d1_minawake']==999
-    data['bl_d1_minawake'][mask] = 0
-    mask = data['bl_d2_minawake']==999
-    data['bl_d2_minawake'][mask] = 0
-
-    # Use the following dictionary to identify the
-    # various measures.
-    # They are indexed by TIME of measurement
-    # WITHIN a single day
-    measure_dict = {    0: 'wake',
-                        1: '30m',
-                        2: 'eve',
-                        3: 'CAR',
-                        4: 'maxam',
-                        5: 'dayAv',
-                        6: 'dayRange' }
-
-    # For now we're only interested in baseline (bl) data
-    # Note that this is bl for b(ase)l(ine) not b'one'
-    
-    return data, measure_dict
+    if name.endswith('minawake'):
+        values[values==999] = 0
+
+    return values
 #--------------------------------------------------------------------
 
-def keep_filter_subs(data, inc_sublist_filename, excl_sublist_filename):
-    if os.path.isfile(inc_sublist_filename):
-        inc_sublist = np.loadtxt(inc_sublist_filename, dtype=int)
-        keep_mask = np.in1d(data['ID'], inc_sublist)
-    else:
-        keep_mask = np.ones(data['ID'].shape)==1
-    if os.path.isfile(excl_sublist_filename):
-        excl_sublist = np.loadtxt(excl_sublist_filename, dtype=int)
-        excl_mask = np.logical_not(np.in1d(data['ID'], excl_sublist))
+def read_data_file(data_filename, chunk_size=10000):
+    '''
+    Read the TAB separated file a chunk of rows at a time,
+    converting each column to its schema dtype (and cleaning it)
+    as we go so we never hold the whole file as text
+    INPUT:      tab separated filename
+                chunk_size (number of rows to parse at once)
+    RETURNS:    data (recarray)
+    '''
+    with open(data_filename) as f:
+        names = [ normalize_column_name(name)
+                    for name in f.readline().rstrip('\r\n').split('\t') ]
+        dtypes = [ define_column_dtype(name) for name in names ]
+        n_cols = len(names)
+
+        chunks = [ [] for name in names ]
+        rows = []
+        for line in it.chain(f, [ None ]):
+            if line is not None:
+                line = line.rstrip('\r\n')
+                if not line.strip():
+                    continue
+                row = line.split('\t')
+                # Pad out any rows that have lost their trailing tabs
+                row.extend([ '' ] * (n_cols - len(row)))
+                rows.append(row[:n_cols])
+
+            if len(rows) == chunk_size or (line is None and rows):
+                columns = zip(*rows)
+                for i, name in enumerate(names):
+                    # Columns that aren't in the schema are kept as text
+                    # until we've seen all of them
+                    if dtypes[i] is None:
+                        chunks[i].append(np.array(columns[i], dtype=str))
+                    else:
+                        chunks[i].append(convert_column(name, columns[i], dtypes[i]))
+                rows = []
+
+    columns = []
+    for name, dtype, chunk in zip(names, dtypes, chunks):
+        if not chunk:
+            column = convert_column(name, [], dtype)
+        elif dtype is None:
+            column = convert_column(name, np.concatenate(chunk), dtype)
+        else:
+            column = np.concatenate(chunk)
+        columns.append(column)
+
+    return np.rec.fromarrays(columns, names=names)
+#--------------------------------------------------------------------
+
+def import_data(data_filename, use_cache=True):
+    '''
+    Read in the data as a TAB separated file
+    Correct some bonkers naming typos
+    Work out the occasions, days and samples in the data
+    (The typos and the 99s are all fixed by read_data_file)
+    If use_cache is True the cleaned data is saved to (and next
+    time loaded from) a binary cache next to the data file
+    INPUT:      tab separated filename
+    RETURNS:    data (recarray)
+                layout (from define_layout)
+    '''
+    data = load_cached_data(data_filename, read_data_file,
+                                [ read_data_file, convert_column,
+                                    define_column_dtype, normalize_column_name ],
+                                use_cache=use_cache)
+    data = data.view(np.recarray)
+
+    layout = define_layout(data.dtype.names)
+
+    return data, layout
+#--------------------------------------------------------------------
+
+def read_selection_criteria(selection_criteria_name):
+    '''
+    Run the selection criteria file (eg: Cortisol_SelectionCriteria.py)
+    in its own namespace and return all your answers
+    INPUT:      selection criteria filename
+    RETURNS:    criteria (dictionary of setting name: answer)
+    '''
+    criteria = dict()
+    execfile(selection_criteria_name, criteria)
+    criteria.pop('__builtins__', None)
+
+    return criteria
+#--------------------------------------------------------------------
+
+def define_sublist_filenames(sublists):
+    '''
+    The include and exclude lists can be one filename or a list
+    of filenames. ' ' (or '') means you don't want that list.
+    '''
+    if isinstance(sublists, str):
+        sublists = [ sublists ]
+    return [ filename for filename in sublists if filename.strip() ]
+#--------------------------------------------------------------------
+
+def define_subject_set(sublists):
+    '''
+    All the subjects in any of the lists (or None if there aren't
+    any lists at all)
+    '''
+    filenames = define_sublist_filenames(sublists)
+    if not filenames:
+        return None
+    return frozenset().union(*[ read_subject_set(filename) for filename in filenames ])
+#--------------------------------------------------------------------
+
+def define_filter_subs_mask(data, inc_sublist_filename, excl_sublist_filename):
+    '''
+    True for every subject who is in one of the include lists (if
+    there are any) and not in any of the exclude lists (if there
+    are any). Each of these can be one filename or a list of them.
+    A list that doesn't exist is an error (rather than quietly
+    letting everyone through).
+    '''
+    include_set = define_subject_set(inc_sublist_filename)
+    exclude_set = define_subject_set(excl_sublist_filename) or frozenset()
+
+    if include_set is None:
+        mask = [ not sub_id in exclude_set for sub_id in data['ID'].tolist() ]
     else:
-        excl_mask = np.ones(data['ID'].shape)==1
-    
-    mask = keep_mask * excl_mask
-    return data[mask]
+        keep_set = include_set - exclude_set
+        mask = [ sub_id in keep_set for sub_id in data['ID'].tolist() ]
+
+    return np.array(mask, dtype=bool)
 #--------------------------------------------------------------------
 
-def excl_med_subs(data, medlist_file, medlist_special_cases_file):
-    # Read in the meds column
-    meds = data['bl_med_name']
+def keep_filter_subs(data, inc_sublist_filename, excl_sublist_filename):
+    mask = define_filter_subs_mask(data, inc_sublist_filename, excl_sublist_filename)
+    return data[mask]
+#--------------------------------------------------------------------
 
+def read_med_lists(medlist_file, medlist_special_cases_file):
+    '''
+    Read in the medications to exclude and the special cases
+    (whole medication entries that should be excluded) and
+    normalize them once so they can be looked up quickly
+    INPUT:      medlist_file
+                medlist_special_cases_file
+    RETURNS:    exclude_meds (set of upper case words)
+                special_cases (set of upper case entries)
+    '''
     # Read in the exclude_meds list
     with open(medlist_file) as f:
         exclude_meds = f.read().splitlines()
     # And make sure all the words are uppercase
-    exclude_meds = [ string.upper(med) for med in exclude_meds ]
-    exclude_meds = [ med.strip() for med in exclude_meds ]
+    # and don't have any leading or trailing whitespace
+    exclude_meds = set([ string.upper(med).strip() for med in exclude_meds ])
 
     # Read in the special cases
     with open(medlist_special_cases_file) as f:
         special_cases = f.read().splitlines()
     # And make sure these special cases are all upper case
-    # and don't have any leading or trailing whitespace
-    special_cases = [ string.upper(case) for case in special_cases ]
-    special_cases = [ case.strip('"') for case in special_cases ]
-    special_cases = [ case.strip() for case in special_cases ]
-
-    # Create a mask that is all True (to start off with)
-    mask = np.ones(meds.shape)==1
-
-    # Loop through and remove all the special cases
-    for i, med in enumerate(meds):
-        med = med.strip('"')
-        med = med.strip()
-        med = string.upper(med)
-        mask[i] = False if med.strip('"') in special_cases else mask[i]
-    
-    # Now loop through and remove any subject that has any of the 
+    # and don't have any leading or trailing whitespace or quotes
+    special_cases = set([ string.upper(case).strip('"').strip() for case in special_cases ])
+
+    return exclude_meds, special_cases
+#--------------------------------------------------------------------
+
+def match_meds(meds, exclude_meds, special_cases):
+    '''
+    Find the subjects who are taking any of the medications
+    we want to exclude.
+    Lots of subjects have exactly the same entry (not least all
+    the empty ones) so each unique entry is only checked once.
+    INPUT:      meds (array of medication strings)
+                exclude_meds (set from read_med_lists)
+                special_cases (set from read_med_lists)
+    RETURNS:    mask (True if the subject can be kept)
+                matched_meds (the medication that excluded the
+                                subject, '' if there isn't one)
+    '''
+    # Split the entries on commas, semicolons, quotes, full stops,
+    # spaces and underscores
+    splitter = re.compile(',|;|"|\.| |_')
+
+    unique_meds, inverse = np.unique(meds, return_inverse=True)
+
+    matched_unique = []
+    for med in unique_meds:
+        matched = ''
+        # First check if the whole entry is one of the special cases
+        case = string.upper(med.strip('"').strip()).strip('"')
+        if case in special_cases:
+            matched = case
+        else:
+            # Otherwise look for any of the exclude meds words
+            for med_word in splitter.split(string.upper(med)):
+                if med_word in exclude_meds:
+                    matched = med_word
+                    break
+        matched_unique.append(matched)
+
+    # (The extra '' makes sure this is a string array even if
+    # there aren't any subjects)
+    matched_meds = np.array(matched_unique + [ '' ])[:-1][inverse]
+    mask = matched_meds == ''
+
+    return mask, matched_meds
+#--------------------------------------------------------------------
+
+def excl_med_subs(data, medlist_file, medlist_special_cases_file):
+    '''
+    Remove the subjects who are taking any of the medications we
+    want to exclude and print which medications they were excluded
+    for (and how many subjects for each one)
+    '''
+    # Read in the meds column
+    meds = data['bl_med_name']
+
+    # Read in the exclude meds and special cases
+    exclude_meds, special_cases = read_med_lists(medlist_file, medlist_special_cases_file)
+
+    # Remove any subject that is a special case or has any of the
     # exclude meds words in their meds column
-    for i, med in enumerate(meds):
-        for med_word in re.sub(',|;|"|\.| ','_', med).split('_'):
-            med_word = string.upper(med_word)
-            mask[i] = False if med_word in exclude_meds else mask[i]
+    mask, matched_meds = match_meds(meds, exclude_meds, special_cases)
+
+    # Report why they were excluded
+    report_med_exclusions(matched_meds)
     
     return data[mask]
+#--------------------------------------------------------------------
+
+def report_med_exclusions(matched_meds):
+    '''
+    Print how many subjects were excluded for each medication
+    INPUT:      matched_meds (from match_meds)
+    '''
+    excluded_meds = matched_meds[matched_meds != '']
+    if len(excluded_meds) == 0:
+        print 'No subjects excluded for medication'
+        return
+    names, counts = np.unique(excluded_meds, return_counts=True)
+    print 'Excluded {n} subjects for medication: {meds}'.format(n=len(excluded_meds),
+                meds=', '.join([ '{med} ({count})'.format(med=med, count=count)
+                                    for med, count in zip(names, counts) ]))
     
 #--------------------------------------------------------------------
 
-def define_selection_column(data, in_column_name, out_column_name, criterion):
+class WorkingTable(OrderedDict):
+    '''
+    The columnar table that the rest of the pipeline writes into.
+    It's an ordered dictionary of column name: array (in the order
+    that the columns are saved) but all the new cortisol columns
+    are views into a handful of occasion x day x sample x subject
+    tensors so that each calculation is done for every occasion,
+    day and sample at once.
+        .layout     the occasions, days and samples (see define_layout)
+        .tensors    the tensors that the new columns are views into
+        .cubes      the input columns stacked into tensors of the
+                        same shape (see build_measure_cube)
+    '''
+    def __init__(self, layout):
+        OrderedDict.__init__(self)
+        self.layout = layout
+        self.tensors = dict()
+        self.cubes = dict()
+#--------------------------------------------------------------------
+
+def define_layout(names):
+    '''
+    Work out which occasions (eg: bl for b(ase)l(ine) not b'one'),
+    days and samples (eg: wake, 30m and eve) of cortisol data we
+    have from the {occasion}_d{day}_{sample}cortisol column names.
+    The first two samples of the day are used for the cortisol
+    awakening response, all but the last sample for the maximum
+    am value and the last sample is the evening measure.
+    INPUT:      names (list of column names)
+    RETURNS:    layout (dictionary of occasions, days, samples,
+                            derived measures and all the measures)
+    '''
+    pattern = re.compile('^([A-Za-z]+)_d([0-9]+)_(.+)cortisol$')
+
+    occasions = []
+    days = []
+    samples = []
+    for name in names:
+        match = pattern.match(name)
+        if match:
+            occasion, day, sample = match.groups()
+            if not occasion in occasions:
+                occasions.append(occasion)
+            if not int(day) in days:
+                days.append(int(day))
+            if not sample in samples:
+                samples.append(sample)
+
+    if len(samples) < 3:
+        raise ValueError('Need at least three cortisol samples a day (two am and one evening)')
+
+    derived = [ 'CAR', 'maxam', 'dayAv', 'dayRange' ]
+
+    layout = {  'occasions': occasions,
+                'days': sorted(days),
+                'samples': samples,
+                'derived': derived,
+                'measures': samples + derived }
+
+    return layout
+#--------------------------------------------------------------------
+
+def define_flag_dtype(n_bits):
+    '''
+    The smallest unsigned integer type that has room for n_bits
+    flags (so the flag and mask columns take up as little
+    space as possible)
+    '''
+    for dtype in [ np.uint8, np.uint16, np.uint32, np.uint64 ]:
+        if n_bits <= np.iinfo(dtype).bits:
+            return dtype
+    raise ValueError('Can\'t fit {n} flags in one column'.format(n=n_bits))
+#--------------------------------------------------------------------
+
+def define_working_tensors(layout):
+    '''
+    List the tensors that hold all the columns the pipeline adds
+    to the data. Each one has subjects as its last axis (so every
+    column is a contiguous slice) and its own dtype.
+    INPUT:      layout
+    RETURNS:    tensors (OrderedDict of name: (shape, dtype))
+                    where shape doesn't include the subjects
+    '''
+    n_occasions = len(layout['occasions'])
+    n_days = len(layout['days'])
+    n_samples = len(layout['samples'])
+
+    tensors = OrderedDict()
+
+    # The selection flags for each individual cortisol measure
+    # (one bit for each criterion that excluded it) and whether
+    # it can be used at all (which isn't saved because it's
+    # just flags == 0)
+    tensors['flags'] = ((n_occasions, n_days, n_samples),
+                            define_flag_dtype(len(define_selection_criteria())))
+    tensors['usable'] = ((n_occasions, n_days, n_samples), np.uint8)
+
+    # The whole day criteria
+    # (useDay has one bit for each day)
+    tensors['useDay'] = ((n_occasions,), define_flag_dtype(n_days))
+    tensors['calc_max'] = ((n_occasions, n_days), np.uint8)
+
+    # The within day comparisons (CAR, maxam, dayAv and dayRange)
+    # The masks are all 0s and 3s apart from maxam which
+    # has one bit for each am sample
+    for measure in layout['derived']:
+        if measure == 'maxam':
+            mask_dtype = define_flag_dtype(n_samples - 1)
+        else:
+            mask_dtype = np.uint8
+        tensors[measure] = ((n_occasions, n_days), float)
+        tensors[measure + '_mask'] = ((n_occasions, n_days), mask_dtype)
+
+    # And the averages across the days
+    # (their masks have one bit for each day)
+    for measure in layout['measures']:
+        tensors['av_' + measure] = ((n_occasions,), float)
+        tensors['av_' + measure + '_mask'] = ((n_occasions,), define_flag_dtype(n_days))
+
+    return tensors
+#--------------------------------------------------------------------
+
+def define_working_schema(layout):
+    '''
+    List all the columns that the pipeline adds to the data
+    (in the order that they're saved) together with the tensor
+    (and the index into it) that holds them
+    INPUT:      layout
+    RETURNS:    schema (list of (name, tensor name, index) tuples)
+    '''
+    schema = []
+
+    for o, occasion in enumerate(layout['occasions']):
+        # The selection flags for each individual cortisol measure
+        for d, day in enumerate(layout['days']):
+            for s, sample in enumerate(layout['samples']):
+                name = '{occ}_d{day}_{time}cortisol_flags'.format(occ=occasion, day=day, time=sample)
+                schema.append((name, 'flags', (o, d, s)))
+
+        # The whole day criteria
+        schema.append(('{occ}_useDay'.format(occ=occasion), 'useDay', (o,)))
+        for d, day in enumerate(layout['days']):
+            name = '{occ}_d{day}_calc_max'.format(occ=occasion, day=day)
+            schema.append((name, 'calc_max', (o, d)))
+
+        # The within day comparisons
+        for d, day in enumerate(layout['days']):
+            for measure in layout['derived']:
+                name = '{occ}_d{day}_{time}cortisol'.format(occ=occasion, day=day, time=measure)
+                schema.append((name, measure, (o, d)))
+                schema.append((name + '_mask', measure + '_mask', (o, d)))
+
+        # And the averages across the days
+        for measure in layout['measures']:
+            name = '{occ}_av_{time}cortisol'.format(occ=occasion, time=measure)
+            schema.append((name, 'av_' + measure, (o,)))
+            schema.append((name + '_mask', 'av_' + measure + '_mask', (o,)))
+
+    return schema
+#--------------------------------------------------------------------
+
+def create_working_table(data, layout):
+    '''
+    Create the columnar table that the rest of the pipeline writes
+    into in place. Every column is its own (contiguous) array and all
+    the new columns are allocated here in one go (as slices of the
+    working tensors) so we never have to copy the whole recarray to
+    add a column.
+    INPUT:      data (recarray)
+                layout
+    RETURNS:    data (WorkingTable of column name: array)
+    '''
+    table = WorkingTable(layout)
+    for name in data.dtype.names:
+        table[name] = np.ascontiguousarray(data[name])
+
+    n_subs = data.shape[0]
+    for name, (shape, dtype) in define_working_tensors(layout).items():
+        table.tensors[name] = np.zeros(shape + (n_subs,), dtype=dtype)
+
+    for name, tensor_name, index in define_working_schema(layout):
+        table[name] = table.tensors[tensor_name][index]
+
+    return table
+#--------------------------------------------------------------------
+
+def define_selection_criteria():
+    '''
+    The criteria that decide whether each individual cortisol
+    measure (one per subject, occasion, day and sample) can be used.
+    Each criterion is a tuple of:
+        name        the name of the criterion (see decode_flags)
+        column      template for the input column name, filled in
+                        with the occasion, day and time (sample)
+        test        comparison to apply ('<', '<=', '==', '>', '>=', '!=')
+                        the measure passes if this is True
+        value       the value to compare the input column to
+        switch      name of the selection criteria setting that turns
+                        this criterion on (None means it is always on).
+                        If it's switched off every measure passes.
+        times       which samples this criterion applies to
+                        (None means all of them)
+    Every measure that fails a criterion gets that criterion's bit
+    (its position in this list) set in its
+    {occ}_d{day}_{time}cortisol_flags column and a measure can only be
+    used if none of its flags are set.
+    To add a new criterion just add a line here (but only ever add
+    them at the end so the flags in old output files still mean the
+    same thing)
+    '''
+    criteria_spec = [
+        # CRITERION: Cortisol data is present
+        # (This criterion is not in the selectioncriteria file because...well...
+        # are we interested in data that doesn't exist??)
+        ( 'HasData', '{occ}_d{day}_{time}cortisol', '<', 99, None, None ),
+        # CRITERION: All cortisol values must be less than 3
+        ( 'Lt3', '{occ}_d{day}_{time}cortisol', '<', 3., 'cort_lt_3', None ),
+        # CRITERION: All cortisol comments have to be '1000'
+        ( 'comment1000', '{occ}_d{day}_{time}comment', '==', str(1000), 'comment_1000', None ),
+        # CRITERION: Wake cortisol has to be acquired within 10 minutes of waking
+        ( 'minawakeLt10', '{occ}_d{day}_minawake', '<', 10, 'minawake_lt10', ('wake',) ) ]
+
+    return criteria_spec
+#--------------------------------------------------------------------
+
+def compile_selection_criteria(criteria_spec, layout):
+    '''
+    Parse the criteria spec once into a list of predicates that can
+    be applied to a whole occasion x day x sample x subject cube in
+    one go
+    INPUT:      criteria_spec (from define_selection_criteria)
+                layout
+    RETURNS:    compiled_criteria (list of (name, column, test,
+                                    function, value, switch,
+                                    applies) tuples)
+    '''
+    test_dict = {   '<': operator.lt,
+                    '<=': operator.le,
+                    '==': operator.eq,
+                    '!=': operator.ne,
+                    '>': operator.gt,
+                    '>=': operator.ge }
+
+    compiled_criteria = []
+    for name, column, test, value, switch, times in criteria_spec:
+        if not test in test_dict:
+            raise ValueError('Unknown test {test} for criterion {name}'.format(test=test, name=name))
+
+        function = test_dict[test]
+
+        # Keep track of which samples this criterion applies to
+        # (the extra axis lines it up with the subjects)
+        applies = np.array([ times is None or sample in times
+                                for sample in layout['samples'] ])[:, None]
+
+        compiled_criteria.append((name, column, test, function, value, switch, applies))
+
+    return compiled_criteria
+#--------------------------------------------------------------------
+
+def build_measure_cube(data, column):
     '''
-    Generic define selection column based on any criterion
-    criterion is passed as a string
+    Stack the input columns for each occasion, day and sample into
+    one occasion x day x sample x subject array
+    Columns that don't depend on the sample (eg minawake) are repeated
+    and any that are missing are filled with 999 (or '' for text)
     '''
-    if not criterion == '':
-        eval_string = 'data[in_column_name]' + criterion
-        mask = eval(eval_string)
-        out_data = np.zeros(data[in_column_name].shape)
-        out_data[mask] = 1
+    layout = data.layout
+    n_subs = data['ID'].shape[0]
+
+    rows = []
+    for occasion in layout['occasions']:
+        for day in layout['days']:
+            for sample in layout['samples']:
+                name = column.format(occ=occasion, day=day, time=sample)
+                rows.append(data[name] if name in data else None)
+
+    present = [ row for row in rows if row is not None ]
+    if present and present[0].dtype.kind in 'SU':
+        missing = np.zeros(n_subs, dtype=present[0].dtype)
     else:
-        out_data = np.ones(data[in_column_name].shape)
-    
-    # Add this column of numbers to the recarray
-    data = rec.append_fields(base=data,
-                        names=out_column_name,
-                        data=out_data,
-                        dtypes=int,
-                        usemask=False,
-                        asrecarray=True )
-    return data
+        missing = np.ones(n_subs) * 999
+    rows = [ row if row is not None else missing for row in rows ]
+
+    cube = np.vstack(rows).reshape(len(layout['occasions']),
+                                    len(layout['days']),
+                                    len(layout['samples']),
+                                    n_subs)
+    return cube
+#--------------------------------------------------------------------
+
+def get_measure_cube(data, column):
+    '''
+    Only build each cube from the input columns once
+    '''
+    if not column in data.cubes:
+        data.cubes[column] = build_measure_cube(data, column)
+    return data.cubes[column]
 #--------------------------------------------------------------------
 
-def create_overall_selection_data(data, measure_name):
+def evaluate_selection_criteria(data, compiled_criteria):
+    '''
+    Apply all the compiled criteria to the data in one pass
+    This doesn't care whether the criteria are switched on or not
+    (that's up to write_criteria_columns) so it only needs to be
+    done once however many different settings you want to try
+    RETURNS:    criteria_results (dictionary of criterion name:
+                                    occasion x day x sample x subject
+                                    boolean array)
+    '''
+    shape = data.tensors['flags'].shape
+    criteria_results = dict()
 
-    names = list(data.dtype.names)
-    
-    # Find all the columns that have the measure name in their title
-    # and also start with the word "Use"
-    use_names = [ name for name in names
-                    if (name.find(measure_name) > 1)
-                        & (name.find('Use') == 0) ]
-    
-    # Now create a numpy array of these columns
-    selection_data = np.vstack([data[use_name] for use_name in use_names])
-    
-    # If there are any zeros then you can't use that data
-    overall_selection_data = np.zeros_like(data[name])
-    overall_selection_data[np.all(selection_data, axis=0)] = 1
+    for name, column, test, function, value, switch, applies in compiled_criteria:
+        result = function(get_measure_cube(data, column), value)
+        # Comparing to the wrong type (eg a string to numbers)
+        # just means nothing passes
+        criteria_results[name] = np.logical_or(np.zeros(shape)==1, result)
+
+    return criteria_results
+#--------------------------------------------------------------------
+
+def write_criteria_columns(data, compiled_criteria, criteria_results, settings):
+    '''
+    Set the bit for each criterion that a measure fails in the
+    {occ}_d{day}_{time}cortisol_flags columns
+    Criteria that are switched off in the settings (or that don't
+    apply to this sample) pass everyone
+    A measure is usable if none of its flags are set
+    '''
+    flags = data.tensors['flags']
+    flags[:] = 0
+
+    for bit, (name, column, test, function, value, switch, applies) in enumerate(compiled_criteria):
+        if switch is not None and not settings[switch]:
+            continue
+
+        failed = np.logical_not(criteria_results[name]) & applies
+        flags[failed] |= 1 << bit
+
+    data.tensors['usable'][:] = flags == 0
 
-    overall_selection_name = 'Use_' + measure_name + '_Overall'
-    
-    # Add this column of numbers to the recarray
-    data = rec.append_fields(base=data,
-                        names=overall_selection_name,
-                        data=overall_selection_data,
-                        dtypes=int,
-                        usemask=False,
-                        asrecarray=True )
     return data
 #--------------------------------------------------------------------
 
-def define_use_day_column(data):
+def decode_flags(flags):
+    '''
+    Turn the values in a {occ}_d{day}_{time}cortisol_flags column
+    into the names of the criteria that excluded each measure
+    (eg: 6 -> 'Lt3,comment1000'). Measures that can be used
+    get an empty string.
+    INPUT:      flags (array of flags, eg: data['bl_d1_wakecortisol_flags'])
+    RETURNS:    reasons (array of comma separated criterion names)
+    '''
+    criteria_names = [ criterion[0] for criterion in define_selection_criteria() ]
+
+    # Lots of subjects have the same flags so only decode each value once
+    unique_flags, inverse = np.unique(np.asarray(flags), return_inverse=True)
+    unique_reasons = [ ','.join([ name for bit, name in enumerate(criteria_names)
+                                    if int(value) >> bit & 1 ])
+                        for value in unique_flags ]
+
+    # (The extra '' makes sure this is a string array even if
+    # there aren't any subjects)
+    reasons = np.array(unique_reasons + [ '' ])[:-1][inverse]
+
+    return reasons
+#--------------------------------------------------------------------
+
+def define_use_day_column(data, settings):
     '''
     # Criterion:
     ## Do you require a whole day's worth of data to consider it in the average?
     '''
-    # We're going to create a column (called use_day) that codes whether you
-    # should use no day's data (0), just day 1 (1), just day 2 (2) or 
+    # We're going to create a column (called useDay) that codes which
+    # days' data you should use. Each day adds its own bit so with two
+    # days that's no day's data (0), just day 1 (1), just day 2 (2) or
     # both days (3)
-    use_day_data = np.zeros(data['ID'].shape)
+    use_day_data = data.tensors['useDay']
+    overall = data.tensors['usable']
+    day_bits = 2 ** np.arange(overall.shape[1])
     
-    if require_whole_day:
+    if settings['require_whole_day']:
         # This means that for each day separately we're going
-        # to see if all three of the cortisol measures are there
-        masks = np.vstack([[use_day_data==1], [use_day_data==1]])
-        for day in range(1,3):
-            name_1 = 'Use_bl_d{day}_wakecortisol_Overall'.format(day=day)
-            name_2 = 'Use_bl_d{day}_30mcortisol_Overall'.format(day=day)
-            name_3 = 'Use_bl_d{day}_evecortisol_Overall'.format(day=day)
-            mask_1 = data[name_1] == 1
-            mask_2 = data[name_2] == 1
-            mask_3 = data[name_3] == 1
-            masks[day-1] = mask_1 * mask_2 * mask_3
-
-        day_1_mask = np.logical_xor(masks[0], masks[1]) * masks[0]
-        day_2_mask = np.logical_xor(masks[0], masks[1]) * masks[1]
-        both_days_mask = masks[0] * masks[1]
-        use_day_data[day_1_mask] = 1
-        use_day_data[day_2_mask] = 2
-        use_day_data[both_days_mask] = 3
+        # to see if all of the cortisol measures are there
+        day_masks = np.all(overall == 1, axis=2)
+        use_day_data[:] = np.sum(day_masks * day_bits[:, None], axis=1)
         
     else:
-        use_day_data = use_day_data + 3
+        use_day_data[:] = np.sum(day_bits)
         
-    # Add this column of numbers to the recarray
-    data = rec.append_fields(base = data,
-                        names = 'bl_useDay',
-                        data = use_day_data,
-                        dtypes=None,
-                        usemask=False,
-                        asrecarray=True )
     return data
 #--------------------------------------------------------------------
 
-def define_calc_max_column(data):
+def define_calc_max_column(data, settings):
     '''
     # Criterion:
     ## Do you require two am values to calculate the maximum am value?
     '''
     # Dead easy, if there are two am values then you can calculate
     # the maximum :)
-    for day in xrange(1,3):
-        calc_max_data_name = 'bl_d{day}_calc_max'.format(day=day)
-        calc_max_data = np.ones(data['ID'].shape)
-        
-        if need_2_am:
-            # Create two separate masks for measure 1 and measure 2:
-            name_1 = 'Use_bl_d{day}_wakecortisol_Overall'.format(day=day)
-            name_2 = 'Use_bl_d{day}_30mcortisol_Overall'.format(day=day)
-            mask_1 = data[name_1] == 1
-            mask_2 = data[name_2] == 1
-            mask = mask_1 * mask_2
-            calc_max_data[mask] = 1
-
-        # Add this column of numbers to the recarray
-        data = rec.append_fields(base=data,
-                            names=calc_max_data_name,
-                            data=calc_max_data,
-                            dtypes=None,
-                            usemask=False,
-                            asrecarray=True )
+    calc_max_data = data.tensors['calc_max']
+    calc_max_data[:] = 1
+
+    if settings['need_2_am']:
+        # Create two separate masks for measure 1 and measure 2:
+        overall = data.tensors['usable']
+        mask_1 = overall[:, :, 0] == 1
+        mask_2 = overall[:, :, 1] == 1
+        mask = mask_1 * mask_2
+        calc_max_data[mask] = 1
+
     return data
 #--------------------------------------------------------------------
 
-def write_selection_columns(data, measure_dict):
+def write_selection_columns(data, settings, compiled_criteria=None, criteria_results=None):
     '''
     Loop through the various selection criteria
+    settings is a dictionary of the answers to the questions
+    in the selection criteria file.
+    If you've already evaluated the criteria (because you're
+    trying lots of different settings) then pass the compiled
+    criteria and their results in and they won't be worked
+    out again.
     '''
     # First one to consider are the criteria that affect individual
-    # measures. First there are the criteria that affect all the cortisol
-    # measures
-    for day in xrange(1,3):
-        for time in xrange(3):
-            '''
-            # CRITERION: Cortisol data is present
-            # (This criterion is not in the selectioncriteria file because...well...
-            # are we interested in data that doesn't exist??)
-            '''
-            in_column_name = 'bl_d{day}_{time}cortisol'.format(day=day, time=measure_dict[time])
-            out_column_name = 'Use_bl_d{day}_{time}cortisol_HasData'.format(day=day, time=measure_dict[time])
-            data = define_selection_column(data, in_column_name, out_column_name, ' < 99')
-            
-            '''
-            # CRITERION: All cortisol values must be less than 3
-            '''
-            in_column_name = 'bl_d{day}_{time}cortisol'.format(day=day, time=measure_dict[time])
-            out_column_name = 'Use_bl_d{day}_{time}cortisol_Lt3'.format(day=day, time=measure_dict[time])
-            if cort_lt_3:
-                data = define_selection_column(data, in_column_name, out_column_name, ' < 3.')
-            else:
-                data = define_selection_column(data, in_column_name, out_column_name, '')
-
-            '''
-            # CRITERION: All cortisol comments have to be '1000'
-            '''
-            in_column_name = 'bl_d{day}_{time}comment'.format(day=day, time=measure_dict[time])
-            out_column_name = 'Use_bl_d{day}_{time}cortisol_comment1000'.format(day=day, time=measure_dict[time])
-            if comment_1000:
-                data = define_selection_column(data, in_column_name, out_column_name, ' == str(1000)')
-            else:
-                data = define_selection_column(data, in_column_name, out_column_name, '')
-    
-            '''
-            # CRITERION: Wake cortisol has to be acquired within 10 minutes of waking
-            '''
-            if time == 0:
-                in_column_name = 'bl_d{day}_minawake'.format(day=day)
-                out_column_name = 'Use_bl_d{day}_{time}cortisol_minawakeLt10'.format(day=day, time=measure_dict[time])
-                if minawake_lt10:
-                    data = define_selection_column(data, in_column_name, out_column_name, ' < 10')
-                else:
-                    data = define_selection_column(data, in_column_name, out_column_name, '')
-    
-            # Having all these separately is fine, but we obviously need them together!
-            # Create an overall yay or nay column for each measure
-            measure_name = 'bl_d{day}_{time}cortisol'.format(day=day, time=measure_dict[time])
-            data = create_overall_selection_data(data, measure_name)
+    # measures. These are all set out in define_selection_criteria
+    # and are applied to all occasions, days and times at once
+    if compiled_criteria is None:
+        compiled_criteria = compile_selection_criteria(define_selection_criteria(), data.layout)
+    if criteria_results is None:
+        criteria_results = evaluate_selection_criteria(data, compiled_criteria)
+    data = write_criteria_columns(data, compiled_criteria, criteria_results, settings)
     
     # Now let's turn to the criteria that affect the whole day
     '''
     # CRITERION: All measures must be present for day to be included in average
     '''
-    data = define_use_day_column(data)
+    data = define_use_day_column(data, settings)
     
     '''
     # CRITERION: Must have two usable am data points to calculate maximum
     '''
-    data = define_calc_max_column(data)
+    data = define_calc_max_column(data, settings)
     
     '''
     # CRITERION: CAR can not be negative
@@ -394,25 +919,18 @@ def write_selection_columns(data, measure_dict):
     return data
 #--------------------------------------------------------------------
 
-def compare_columns(data, name_1, name_2, name_combo, mask, function):
+def compare_arrays(data_1, data_2, data_combo, mask, function):
     '''
-    Compare two columns and if there is data in both of them
-    complete a particular function:
+    Compare two arrays (of any shape) and if there is data in both
+    of them complete a particular function:
         Functions can be 'average', 'diff' or 'max'
-    The mask is a column of 0, 1, 2 and 3 which tells you whether to
-    use neither data point (999), only data['name_1'], only data['name_2']
+    The mask is an array of 0, 1, 2 and 3 which tells you whether to
+    use neither data point (999), only data_1, only data_2
     or carryout the function on both data.
-
-    Returns: data
+    The answer is written into data_combo (in place)
     '''
-
-    # Define your data
-    data_1 = data[ name_1 ]
-    data_2 = data[ name_2 ]
-    data_combo_name = name_combo
-    
     # Fill in the data initally with 999s
-    data_combo = np.ones_like(data_1) * 999.
+    data_combo[:] = 999.
     
     # If there is only one data point fill that in
     data_combo[mask==1] = data_1[mask==1]
@@ -425,234 +943,217 @@ def compare_columns(data, name_1, name_2, name_combo, mask, function):
         data_combo[mask==3] = ( data_2[mask==3] - data_1[mask==3] )
     elif function == 'max':
         data_combo[mask==3] = np.maximum( data_2[mask==3], data_1[mask==3] )
-
-    # Append this data to our recarray
-    data = rec.append_fields(base=data,
-                        names=name_combo,
-                        data=data_combo,
-                        dtypes=None,
-                        usemask=False,
-                        asrecarray=True )
-                        
-    # And also include a copy of the mask
-    data = rec.append_fields(base=data,
-                        names=name_combo + '_mask',
-                        data=mask,
-                        dtypes=None,
-                        usemask=False,
-                        asrecarray=True )
-    
-    
-    return data
 #--------------------------------------------------------------------
 
-def run_comparisons_within_day(data, measure_dict):
+def run_comparisons_within_day(data, settings):
     '''
     Here we calculate the four additional measures of interest:
         maxam
         CAR
         dayAv
         dayRange
+    for every occasion and day at once
     
     If excl_wakemin_gt_10 is true then we will mask with the answer
     to the question:
         "Do you want to exclude waking measures that were collected
         more than 10 minutes after waking?
     '''
-    for day in xrange(1,3):
-        #------------------------------------------------------------
-        # Calculate the cortisol awakening response
-        # which is the difference between the morning measures
-        name_1 = 'bl_d{day}_wakecortisol'.format(day=day)
-        name_2 = 'bl_d{day}_30mcortisol'.format(day=day)
-        name_diff = 'bl_d{day}_CARcortisol'.format(day=day)
-
-        usevalue_1_name = 'Use_bl_d{day}_wakecortisol_Overall'.format(day=day)
-        usevalue_2_name = 'Use_bl_d{day}_30mcortisol_Overall'.format(day=day)
-        
-        usevalue_1 = data[usevalue_1_name]
-        usevalue_2 = data[usevalue_2_name]
-        
-        # We can't calculate the difference if there is only 1 data point
-        # usevalue column is only 0s and 3s
-        usevalue = (usevalue_1 * usevalue_2) * 3
-
-        data = compare_columns(data, name_1, name_2, name_diff, usevalue, 'diff')
+    tensors = data.tensors
+    # Everything here is occasion x day x sample x subject
+    # (or occasion x day x subject once we've picked the sample)
+    cortisol = get_measure_cube(data, '{occ}_d{day}_{time}cortisol')
+    overall = tensors['usable']
+
+    #------------------------------------------------------------
+    # Calculate the cortisol awakening response
+    # which is the difference between the first two morning measures
+    # We can't calculate the difference if there is only 1 data point
+    # usevalue is only 0s and 3s
+    usevalue = ( overall[:, :, 0] * overall[:, :, 1] ) * 3
+
+    compare_arrays(cortisol[:, :, 0], cortisol[:, :, 1], tensors['CAR'], usevalue, 'diff')
+    tensors['CAR_mask'][:] = usevalue
         
-        #------------------------------------------------------------
-        # Replace values that are negative with 999 if excl_neg_CAR is True
-        if excl_neg_CAR:
-            mask_excl_neg = data[name_diff] < 0
-            data[name_diff][mask_excl_neg] = 999
-        #------------------------------------------------------------
+    #------------------------------------------------------------
+    # Replace values that are negative with 999 if excl_neg_CAR is True
+    if settings['excl_neg_CAR']:
+        tensors['CAR'][tensors['CAR'] < 0] = 999
+    #------------------------------------------------------------
         
-        # Calculate the maximum morning cortisol measure
-        # defined as the largest of the two morning measures
-        # and uses the same input data as the CAR
-        # INPUT: name_1, name_2 (from above)
-        # OUTPUT name_max
-        name_max = 'bl_d{day}_maxamcortisol'.format(day=day)
-
-        # but a different mask for the values to use
-        # combining usevalue_1 and usevalue_2 with 
-        # the mask_calc_max column of 1s and 0s
-        calc_max_name = 'bl_d{day}_calc_max'.format(day=day)
-        usevalue_calc_max = data[calc_max_name]
-
-        usevalue_xor_1 = np.logical_xor(usevalue_1==1, usevalue_2==1) * usevalue_1
-        usevalue_xor_2 = np.logical_xor(usevalue_1==1, usevalue_2==1) * usevalue_2
-        usevalue[usevalue_xor_1==1] = 1
-        usevalue[usevalue_xor_2==1] = 2
-
-        usevalue = usevalue_calc_max * usevalue
-
-        data = compare_columns(data, name_1, name_2, name_max, usevalue, 'max')
+    # Calculate the maximum morning cortisol measure
+    # defined as the largest of the morning (all but the last) measures
+    # The usevalue codes which of them we can use: each am measure
+    # adds its own bit so with two of them that's neither (0), only
+    # the first (1), only the second (2) or both (3)
+    use_am = overall[:, :, :(-1)] == 1
+    am_bits = 2 ** np.arange(use_am.shape[2])
+    usevalue = np.sum(use_am * am_bits[:, None], axis=2)
+
+    # and then combine it with the calc_max column of 1s and 0s
+    usevalue = tensors['calc_max'] * usevalue
+
+    max_am = np.max(np.where(use_am, cortisol[:, :, :(-1)], -np.inf), axis=2)
+    tensors['maxam'][:] = 999.
+    tensors['maxam'][usevalue <> 0] = max_am[usevalue <> 0]
+    tensors['maxam_mask'][:] = usevalue
         
-        #------------------------------------------------------------
-        # Calculate the daytime average cortisol measure
-        # defined as the difference between the daytime max
-        # and the evening value
-        name_1 = 'bl_d{day}_maxamcortisol'.format(day=day)
-        name_2 = 'bl_d{day}_evecortisol'.format(day=day)
-        name_av = 'bl_d{day}_dayAvcortisol'.format(day=day)
+    #------------------------------------------------------------
+    # Calculate the daytime average cortisol measure
+    # defined as the average of the daytime max and the
+    # evening (last) value
+    # For maxam use the usevalue mask from the previous calculation
+    # but binarize it to just 1s and 0s
+    usevalue[usevalue <> 0] = 1
         
-        # For maxam use the usevalue mask from the previous calculation
-        # but binarize it to just 1s and 0s
-        usevalue_1 = usevalue
-        usevalue_1[usevalue <> 0] = 1
-        # And get the use eve cortisol overall column for usevalue_2
-        usevalue_2_name = 'Use_bl_d{day}_evecortisol_Overall'.format(day=day)
-        usevalue_2 = data[usevalue_2_name]
-        
-        # You can't calculate the average or range if you only have one
-        # datapoint!
-        usevalue = ( usevalue_1 * usevalue_2 ) * 3
-
-        data = compare_columns(data, name_1, name_2, name_av, usevalue, 'average')
-        # And also calculate the range in cortisol values
-        # throughout the day
-        name_diff = 'bl_d{day}_dayRangecortisol'.format(day=day)
-        data = compare_columns(data, name_2, name_1, name_diff, usevalue, 'diff')
+    # You can't calculate the average or range if you only have one
+    # datapoint!
+    usevalue = ( usevalue * overall[:, :, (-1)] ) * 3
+
+    compare_arrays(tensors['maxam'], cortisol[:, :, (-1)], tensors['dayAv'], usevalue, 'average')
+    tensors['dayAv_mask'][:] = usevalue
+    # And also calculate the range in cortisol values
+    # throughout the day
+    compare_arrays(cortisol[:, :, (-1)], tensors['maxam'], tensors['dayRange'], usevalue, 'diff')
+    tensors['dayRange_mask'][:] = usevalue
     
     return data
 #--------------------------------------------------------------------
 
-def run_comparisons_across_day(data, measure_dict):        
+def run_comparisons_across_day(data):
     '''
-    Here we calculate the average measure across the two days
-    We mask with the results from the bl_useDay column that
+    Here we calculate the average measure across the days
+    (for every occasion and measure at once)
+    We mask with the results from the useDay column that
     was created based on the selection criterion:
     "Do you require a whole day's worth of data to consider
     it in the average?"
     '''
+    layout = data.layout
+    tensors = data.tensors
+    cortisol = get_measure_cube(data, '{occ}_d{day}_{time}cortisol')
+    day_bits = 2 ** np.arange(len(layout['days']))
+    use_day = tensors['useDay'].astype(int)
 
-    # Calculate the average across days for the various measures
-    for time in xrange(7):
-        name_1 = 'bl_d1_{time}cortisol'.format(time=measure_dict[time])
-        name_2 = 'bl_d2_{time}cortisol'.format(time=measure_dict[time])
-        name_av = 'bl_av_{time}cortisol'.format(time=measure_dict[time])
-        
+    for measure in layout['measures']:
         # Now to create the mask
-        # Our first step is to look for either the Overall column,
+        # Our first step is to look for either the usable measures,
         # or the mask column
-        usedata_name_1 = 'Use_bl_d1_{time}cortisol_Overall'.format(time=measure_dict[time])
-        usedata_name_2 = 'Use_bl_d2_{time}cortisol_Overall'.format(time=measure_dict[time])
-        
-        if usedata_name_1 in list(data.dtype.names):
-            usedata_1 = data[usedata_name_1]
-            usedata_2 = data[usedata_name_2]
-            usevalue = ( usedata_1 * usedata_2 ) * 3
-
+        if measure in layout['samples']:
+            s = layout['samples'].index(measure)
+            usedata = tensors['usable'][:, :, s]
+            values = cortisol[:, :, s]
         else:
-            usedata_name_1 = 'bl_d1_{time}cortisol_mask'.format(time=measure_dict[time])
-            usedata_name_2 = 'bl_d2_{time}cortisol_mask'.format(time=measure_dict[time])
-            usedata_1 = np.copy(data[usedata_name_1])
-            usedata_2 = np.copy(data[usedata_name_2])
-            usedata_1[usedata_1 > 0] = 1
-            usedata_2[usedata_2 > 0] = 1
-            usevalue = ( usedata_1 * usedata_2 ) * 3
-
-        usevalue_xor_1 = np.logical_xor(usedata_1, usedata_2) * usedata_1
-        usevalue_xor_2 = np.logical_xor(usedata_1, usedata_2) * usedata_2
-        
-        usevalue[usevalue_xor_1==1] = 1
-        usevalue[usevalue_xor_2==1] = 2
-        
-        useday = data['bl_useDay']
-
-        # Combine your day masks:
-        # I can't think of a better way of writing this!!!
-        for i in xrange(usevalue.shape[0]):
-            if useday[i] == 0:
-                usevalue[i] = 0
-            elif useday[i] == 1:
-                if usevalue[i] == 2:
-                    usevalue[i] = 0
-                elif usevalue[i] == 3:
-                    usevalue[i] = 1
-            elif useday[i] == 2:
-                if usevalue[i] == 1:
-                    usevalue[i] = 0
-                elif usevalue[i] == 3:
-                    usevalue[i] = 2
-        
-        data = compare_columns(data, name_1, name_2, name_av, usevalue, 'average')
+            usedata = tensors[measure + '_mask']
+            values = tensors[measure]
+
+        # Code which days we can use in the same way as the
+        # useDay column (one bit per day) and then only keep
+        # the days that useDay says you can use
+        usevalue = np.sum((usedata > 0) * day_bits[:, None], axis=1)
+        usevalue = usevalue & use_day
+
+        # And average across those days
+        use_days = ( usevalue[:, None, :] & day_bits[:, None] ) > 0
+        n_days = np.sum(use_days, axis=1)
+        total = np.sum(np.where(use_days, values, 0.), axis=1)
+
+        av = tensors['av_' + measure]
+        av[:] = 999.
+        av[n_days > 0] = total[n_days > 0] / n_days[n_days > 0]
+        tensors['av_' + measure + '_mask'][:] = usevalue
     
     return data
 #--------------------------------------------------------------------
 
-def data_report(data, criteria_title):
+def define_usable_mask(data, name):
     '''
-    This function creates figures of the data and
-    ---WILL---
-    contain tables of Ns etc.
-    This function creates a table of N's for each possible
-    combination of exclusion criteria
-    
-    These critera include:
-        Any cortisol level being > 3
-        Min after waking > 10
+    True for every subject who has a usable value for
+    this cortisol measure
     '''
-    all_mask = np.ones_like(data['bl_av_evecortisol'])==1
-    mask = all_mask
-    
-    names = list(data.dtype.names)
-    names = [ name for name in names if name.find('cortisol') > 0 ]
-    names = [ name for name in names if name.find('bl') == 0 ]
-    names = [ name for name in names if not name.find('mask') > 0 ]
-    av_names = [ name for name in names if name.find('av') > 0 ]
-    d1_names = [ name for name in names if name.find('_d1_') > 0 ]
-    d2_names = [ name for name in names if name.find('_d2_') > 0 ]
-    
-    fig, axarr = plt.subplots(nrows=7, ncols=3, figsize = (8, 12), sharex='col', sharey='row')
+    mask = data[name]<>999
+    if '{name}_flags'.format(name=name) in data:
+        mask_use = data['{name}_flags'.format(name=name)]==0
+        mask = mask * mask_use
+    else:
+        mask_use = data['{name}_mask'.format(name=name)] <> 0
+        mask = mask * mask_use
+    return mask
+#--------------------------------------------------------------------
+
+def collect_report_data(data, occasion):
+    '''
+    Work out what goes in each panel of the report figure for
+    one occasion: the usable values for each measure (rows) on
+    each day and averaged across the days (columns)
+    RETURNS:    report_data (list of (row, column, values) tuples)
+    '''
+    layout = data.layout
+    name_templates = [ '{occ}_d%d_{time}cortisol' % day for day in layout['days'] ]
+    name_templates.append('{occ}_av_{time}cortisol')
     
-    xlabels = [ 'Day 1', 'Day 2', 'Average' ]
-    ylabels = [ 'Wake', 'Wake + 30min', 'Evening', 'CAR', 'max AM', 'Day Average', 'Day Range' ]
-
-    for j, name_list in enumerate( [ d1_names, d2_names, av_names ]):
-        for i, name in enumerate(name_list):
-            mask = data[name]<>999
-            if 'Use_{name}_Overall'.format(name=name) in list(data.dtype.names):
-                mask_use = data['Use_{name}_Overall'.format(name=name)]==1
-                mask = mask * mask_use
-            else:
-                mask_use = data['{name}_mask'.format(name=name)] <> 0
-                mask = mask * mask_use
-            axarr[i,j].hist(data[name][mask], bins=10)
-            axarr[i,j].set_xlabel('cortisol value\n' + xlabels[j])
-            axarr[i,j].set_ylabel(ylabels[i])
-            xmajorlocator = MaxNLocator(5)
-            axarr[i,j].xaxis.set_major_locator(xmajorlocator)
-            ymajorlocator = MaxNLocator(5)
-            axarr[i,j].yaxis.set_major_locator(ymajorlocator)
-            n = np.sum([mask])
-            plt.text( 0.8, 0.9,
-                    'N: {n}'.format(n=n) ,
-                    horizontalalignment = 'center' ,
-                    verticalalignment = 'center' ,
-                    transform = axarr[i,j].transAxes ,
-                    fontsize = 10 )
-            axarr[i,j].set_title(xlabels[j])
+    report_data = []
+    for j, name_template in enumerate(name_templates):
+        for i, measure in enumerate(layout['measures']):
+            name = name_template.format(occ=occasion, time=measure)
+            mask = define_usable_mask(data, name)
+            report_data.append((i, j, data[name][mask]))
+
+    return report_data
+#--------------------------------------------------------------------
+
+def define_report_labels(layout):
+    '''
+    The column (day) and row (measure) labels for the report figure
+    '''
+    label_dict = {  'wake': 'Wake',
+                    '30m': 'Wake + 30min',
+                    'eve': 'Evening',
+                    'CAR': 'CAR',
+                    'maxam': 'max AM',
+                    'dayAv': 'Day Average',
+                    'dayRange': 'Day Range' }
+
+    xlabels = [ 'Day {day}'.format(day=day) for day in layout['days'] ] + [ 'Average' ]
+    ylabels = [ label_dict.get(measure, measure) for measure in layout['measures'] ]
+
+    return xlabels, ylabels
+#--------------------------------------------------------------------
+
+def render_report(report_data, criteria_title, fig_filename, xlabels, ylabels):
+    '''
+    Draw the measures x days grid of histograms and save it to fig_filename
+    matplotlib is only imported in here (and always with the
+    Agg backend) so runs that don't want figures never load it
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import MaxNLocator
+
+    nrows = len(ylabels)
+    ncols = len(xlabels)
+    # (8 x 12 inches for the usual 7 measures and 2 days)
+    fig, axarr = plt.subplots(nrows=nrows, ncols=ncols,
+                                figsize = (8. * ncols / 3, 12. * nrows / 7),
+                                sharex='col', sharey='row', squeeze=False)
+
+    for i, j, values in report_data:
+        axarr[i,j].hist(values, bins=10)
+        axarr[i,j].set_xlabel('cortisol value\n' + xlabels[j])
+        axarr[i,j].set_ylabel(ylabels[i])
+        xmajorlocator = MaxNLocator(5)
+        axarr[i,j].xaxis.set_major_locator(xmajorlocator)
+        ymajorlocator = MaxNLocator(5)
+        axarr[i,j].yaxis.set_major_locator(ymajorlocator)
+        n = values.shape[0]
+        axarr[i,j].text( 0.8, 0.9,
+                'N: {n}'.format(n=n) ,
+                horizontalalignment = 'center' ,
+                verticalalignment = 'center' ,
+                transform = axarr[i,j].transAxes ,
+                fontsize = 10 )
+        axarr[i,j].set_title(xlabels[j])
     
     [a.set_ylabel(ylabel='') for a in axarr[:,1:].reshape(-1)]
     [a.set_xlabel(xlabel='') for a in axarr[:(-1),:].reshape(-1)]
@@ -663,114 +1164,838 @@ def data_report(data, criteria_title):
     [a.yaxis.set_label_coords(-0.25, 0.5) for a in axarr[:,0].reshape(-1)]
     
     fig.subplots_adjust(top=0.85)
-    plt.suptitle(criteria_title)
-    fig_filename = os.path.splitext(output_filename)[0] + '.png'
+    fig.suptitle(criteria_title)
     
-    plt.savefig(fig_filename, dpi=None, facecolor='w', edgecolor='w',
+    fig.savefig(fig_filename, dpi=None, facecolor='w', edgecolor='w',
           orientation='portrait', papertype=None, format=None,
           transparent=True, bbox_inches=None, pad_inches=0.1)
+    plt.close(fig)
+#--------------------------------------------------------------------
+
+def data_report(data, criteria_title, fig_filename, background=False):
+    '''
+    This function creates figures of the data
+    (The table of N's for each possible combination of
+    exclusion criteria is made by criteria_sweep)
+
+    If background is True the figure is drawn in a separate
+    process and that process is returned so you can get on
+    with something else (like saving the data) and join it later.
+    Otherwise the figure is drawn straight away and None is returned.
+
+    There's one figure for each occasion: the first one is saved
+    to fig_filename and the others have the occasion added to the
+    end of the name (eg: output_fu.png)
+    '''
+    layout = data.layout
+    xlabels, ylabels = define_report_labels(layout)
+
+    figures = []
+    for o, occasion in enumerate(layout['occasions']):
+        if o == 0:
+            occasion_fig_filename = fig_filename
+            occasion_title = criteria_title
+        else:
+            fig_basename, fig_ext = os.path.splitext(fig_filename)
+            occasion_fig_filename = '{base}_{occ}{ext}'.format(base=fig_basename, occ=occasion, ext=fig_ext)
+            occasion_title = '{occ}: {title}'.format(occ=occasion, title=criteria_title)
+        figures.append((collect_report_data(data, occasion), occasion_title,
+                            occasion_fig_filename, xlabels, ylabels))
+
+    if background:
+        report_process = multiprocessing.Process(target=render_reports, args=(figures,))
+        report_process.start()
+        return report_process
+
+    render_reports(figures)
+    return None
+#--------------------------------------------------------------------
+
+def render_reports(figures):
+    '''
+    Draw each of the figures in turn
+    (figures is a list of arguments for render_report)
+    '''
+    for figure in figures:
+        render_report(*figure)
+#--------------------------------------------------------------------
+
+def format_column(column):
+    '''
+    Turn a column of the table into a list of strings
+    Floats are written at full precision, ints as ints
+    and strings as they are
+    '''
+    if np.issubdtype(column.dtype, np.floating):
+        return [ repr(x) for x in column.tolist() ]
+    elif np.issubdtype(column.dtype, np.integer):
+        return [ '%d' % x for x in column.tolist() ]
+    else:
+        return [ str(x) for x in column.tolist() ]
+#--------------------------------------------------------------------
+
+def write_table(names, columns, output_filename, chunk_size=10000):
+    '''
+    Write the columns out to a TAB delimited text file with
+    a header row. The rows are formatted and written a chunk
+    at a time straight to the output file.
+    '''
+    with open(output_filename, 'wb') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(names)
+
+        n_subs = columns[0].shape[0] if columns else 0
+        for start in xrange(0, n_subs, chunk_size):
+            formatted_columns = [ format_column(column[start:start+chunk_size])
+                                    for column in columns ]
+            writer.writerows(zip(*formatted_columns))
+#--------------------------------------------------------------------
+
+def define_short_name(name, layout):
+    '''
+    Turn an average column name into a shorter and easier
+    to manage variable name (eg: bl_av_wakecortisol -> WakeCort)
+    The first occasion (baseline) doesn't get a prefix but the
+    others do (eg: fu_av_wakecortisol -> FuWakeCort)
+    '''
+    occasion, name = name.split('_av_', 1)
+    name = name[:(-8)]
+    short_name = name[0].upper() + name[1:] + 'Cort'
+    if not occasion == layout['occasions'][0]:
+        short_name = occasion[0].upper() + occasion[1:] + short_name
+    return short_name
 #--------------------------------------------------------------------
 
-def data_save(data, output_filename):
+def data_save(data, output_filename, sidecar=False):
+    '''
+    Save the working table as a TAB delimited text file
+    If sidecar is True also save all the columns to a compressed
+    numpy .npz file (with the same name but a different ending)
+    that downstream tools can load without parsing any text
+    '''
     # This isn't too hard, except we're going to put a copy of the
     # measures we actually care about at the beginning!
-    names = list(data.dtype.names)
+    names = data.keys()
     
-    # Find all the columns that have 'av' in their title and not
-    # and not '_mask'
-    drop_names = [ name for name in names if (name.find('_av_') == -1) | (name.find('_mask') > 0) ]
-    drop_names.pop(0)
+    # Keep the first (ID) column and all the columns that have 'av'
+    # in their title and not '_mask'
+    important_names = [ name for name in names[1:]
+                            if (name.find('_av_') > -1) & (name.find('_mask') == -1) ]
+    important_names.insert(0, names[0])
 
-    important_data = rec.drop_fields(data, drop_names, usemask=False, asrecarray=True)
-    
-    names = list(important_data.dtype.names)
-    
     # Strip the beginning part to get shorter and easy to manage variable names
-    names[1:] = [ name[6:] for name in names[1:] ]
-    names[1:] = [ name[:(-8)] for name in names[1:] ]
-    names[1:] = [ name[0].upper() + name[1:] + 'Cort' for name in names[1:] ]
-    names[0] = 'SubID'
-    important_data.dtype.names = names
-
-    # Create two temporaray output_filenames:
-    temp_filename1 = output_filename + '_temp1'
-    temp_filename2 = output_filename + '_temp2'
-    
-    plt.rec2csv(data, temp_filename1, delimiter='\t', formatd=None, withheader=True)
-    plt.rec2csv(important_data, temp_filename2, delimiter='\t', formatd=None, withheader=True)
+    short_names = [ 'SubID' ] + [ define_short_name(name, data.layout) for name in important_names[1:] ]
+
+    # The important columns go first and then everything else
+    out_names = short_names + names
+    out_columns = [ data[name] for name in important_names + names ]
+
+    write_table(out_names, out_columns, output_filename)
+
+    if sidecar:
+        sidecar_filename = os.path.splitext(output_filename)[0] + '.npz'
+        np.savez_compressed(sidecar_filename, **OrderedDict(zip(out_names, out_columns)))
+#--------------------------------------------------------------------
+
+def flags_save(data, flags_filename):
+    '''
+    Save a table that explains the flags columns: for each
+    cortisol measure the number of subjects who can use it and
+    the number excluded by each of the selection criteria
+    (a measure can be excluded by more than one criterion)
+    '''
+    criteria_names = [ criterion[0] for criterion in define_selection_criteria() ]
+    flag_names = [ name for name in data.keys() if name.endswith('cortisol_flags') ]
+
+    n_usable = []
+    n_excluded = [ [] for criterion_name in criteria_names ]
+    for flag_name in flag_names:
+        n_usable.append(np.sum(data[flag_name] == 0))
+        for bit, counts in enumerate(n_excluded):
+            counts.append(np.sum(data[flag_name] >> bit & 1))
+
+    names = [ 'measure', 'N_usable' ] + [ 'N_excl_' + name for name in criteria_names ]
+    columns = ( [ np.array([ name[:(-6)] for name in flag_names ] + [ '' ])[:-1],
+                    np.array(n_usable, dtype=int) ]
+                + [ np.array(counts, dtype=int) for counts in n_excluded ] )
+
+    write_table(names, columns, flags_filename)
+#--------------------------------------------------------------------
     
-    mcf.KW_paste(temp_filename2, temp_filename1, output_filename)
-    mcf.KW_rmforce(temp_filename1)
-    mcf.KW_rmforce(temp_filename2)
+def criteria_sweep(data, layout, settings, sweep_filename, averages_filename=None):
+    '''
+    Work out the Ns for every possible combination of the
+    selection criteria in one go.
+    The data is only read once, each criterion is only evaluated
+    once and then they're combined for each of the 2^8 settings.
+    The criteria that pick out whole subjects (excl_med and
+    filter_subs) are just masks on the rows so they're combined
+    with the results at the very end.
+    INPUT:      data (recarray, before any subjects are filtered)
+                layout (from define_layout)
+                settings (dictionary of the selection criteria
+                            answers - used for the filenames)
+                sweep_filename (where to save the table of Ns)
+                averages_filename (if given, where to save the
+                            averaged measures for every setting)
+    '''
+    measure_switches = [ 'cort_lt_3', 'comment_1000', 'minawake_lt10',
+                            'require_whole_day', 'need_2_am', 'excl_neg_CAR' ]
+    subject_switches = [ 'excl_med', 'filter_subs' ]
+
+    # Work out the subject masks
+    subject_masks = dict()
+    medlist_file = settings.get('medlist_file', ' ')
+    medlist_special_cases_file = settings.get('medlist_special_cases_file', ' ')
+    if os.path.isfile(medlist_file) and os.path.isfile(medlist_special_cases_file):
+        exclude_meds, special_cases = read_med_lists(medlist_file, medlist_special_cases_file)
+        subject_masks['excl_med'], matched_meds = match_meds(data['bl_med_name'], exclude_meds, special_cases)
+    else:
+        print 'Can\'t find the medication lists - excl_med won\'t exclude anyone in the sweep'
+        subject_masks['excl_med'] = np.ones(data['ID'].shape)==1
+    try:
+        subject_masks['filter_subs'] = define_filter_subs_mask(data,
+                                            settings.get('include_subs_list', ' '),
+                                            settings.get('exclude_subs_list', ' '))
+    except IOError:
+        print 'Can\'t find the subject lists - filter_subs won\'t exclude anyone in the sweep'
+        subject_masks['filter_subs'] = np.ones(data['ID'].shape)==1
+
+    # Set up the working table and evaluate all the criteria once
+    data = create_working_table(data, layout)
+    compiled_criteria = compile_selection_criteria(define_selection_criteria(), layout)
+    criteria_results = evaluate_selection_criteria(data, compiled_criteria)
+
+    av_names = [ '{occ}_av_{time}cortisol'.format(occ=occasion, time=measure)
+                    for occasion in layout['occasions']
+                    for measure in layout['measures'] ]
+    short_names = [ define_short_name(name, layout) for name in av_names ]
+
+    sweep_rows = []
+    averages_rows = []
+    for measure_combo in it.product([ False, True ], repeat=len(measure_switches)):
+        combo_settings = dict(settings)
+        combo_settings.update(zip(measure_switches, measure_combo))
+
+        # Everything is written in place so we can reuse the same table
+        data = write_selection_columns(data, combo_settings,
+                                        compiled_criteria, criteria_results)
+        data = run_comparisons_within_day(data, combo_settings)
+        data = run_comparisons_across_day(data)
+
+        usable_array = np.vstack([ define_usable_mask(data, name) for name in av_names ])
+
+        for subject_combo in it.product([ False, True ], repeat=len(subject_switches)):
+            keep_mask = np.ones(data['ID'].shape)==1
+            for switch, on in zip(subject_switches, subject_combo):
+                if on:
+                    keep_mask = keep_mask & subject_masks[switch]
+
+            switch_values = [ int(on) for on in measure_combo + subject_combo ]
+            n_array = np.sum(usable_array & keep_mask, axis=1)
+            sweep_rows.append(switch_values + [ np.sum(keep_mask) ] + list(n_array))
+
+            if averages_filename:
+                n_keep = np.sum(keep_mask)
+                averages_rows.append([ np.ones(n_keep, dtype=int) * on for on in switch_values ]
+                                        + [ data['ID'][keep_mask] ]
+                                        + [ data[name][keep_mask] for name in av_names ])
+
+    # Save the table of Ns
+    switch_names = measure_switches + subject_switches
+    sweep_names = switch_names + [ 'N' ] + [ 'N_' + name for name in short_names ]
+    write_table(sweep_names, [ np.array(column) for column in zip(*sweep_rows) ], sweep_filename)
+
+    # And (if you want them) the averages for each setting
+    if averages_filename:
+        averages_names = switch_names + [ 'SubID' ] + short_names
+        averages_columns = [ np.concatenate(column) for column in zip(*averages_rows) ]
+        write_table(averages_names, averages_columns, averages_filename)
 #--------------------------------------------------------------------
     
-#====================================================================
-# MAIN CODE
-#====================================================================
-# Run the main body of the script
+def bootstrap_sums(stats, n_boot=10000, seed=0, max_chunk_mb=64):
+    '''
+    The batched resampling engine behind bootstrap_save
+    Every resample picks n_subs subjects (with replacement) and
+    then adds up every row of stats over those subjects. The same
+    resamples are used for every row so all the measures (and all
+    the sums you need for them) are done at once.
+    The resamples are made a chunk at a time as an
+    n_chunk x n_subs matrix of how many times each subject was
+    picked so that the sums are just one matrix multiplication and
+    the matrix never takes up more than max_chunk_mb of memory.
+    INPUT:      stats (n_stats x n_subs array)
+                n_boot (number of resamples)
+                seed (for the random number generator so you
+                        always get the same answer)
+    RETURNS:    sums (n_boot x n_stats array)
+                (all 0s if there aren't any subjects to pick)
+    '''
+    random_state = np.random.RandomState(seed)
+    n_stats, n_subs = stats.shape
+    if n_subs == 0:
+        return np.zeros((n_boot, n_stats))
+    chunk_size = int(max(1, min(n_boot, max_chunk_mb * 1024 * 1024 / 8 / max(n_subs, 1))))
+
+    sums = np.zeros((n_boot, n_stats))
+    for start in xrange(0, n_boot, chunk_size):
+        n_chunk = min(chunk_size, n_boot - start)
+        # The index matrix for this chunk (which subjects are picked)
+        # turned into the number of times each subject is picked
+        index = random_state.randint(0, n_subs, size=(n_chunk, n_subs))
+        index += np.arange(n_chunk)[:, None] * n_subs
+        counts = np.bincount(index.ravel(), minlength=n_chunk * n_subs).reshape(n_chunk, n_subs)
+        sums[start:start+n_chunk] = np.dot(counts, stats.T)
+
+    return sums
+#--------------------------------------------------------------------
+
+def calculate_correlation(sums):
+    '''
+    Pearson's correlation from the sums of:
+        n, x, y, x^2, y^2 and xy (in that order along the last axis)
+    It's nan if there are fewer than 3 subjects or no variance
+    '''
+    n, x, y, xx, yy, xy = [ sums[..., i] for i in xrange(6) ]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = xy - x * y / n
+        r = covariance / np.sqrt((xx - x * x / n) * (yy - y * y / n))
+    r[(n < 3) | np.logical_not(np.isfinite(r))] = np.nan
+    return np.clip(r, -1, 1)
+#--------------------------------------------------------------------
 
+def bootstrap_save(data, bootstrap_filename, n_boot=10000, seed=0, alpha=0.05):
+    '''
+    Bootstrap confidence intervals for the mean of each averaged
+    cortisol measure (the {occ}_av_{time}cortisol columns) and for
+    the day to day reliability (the correlation between day 1 and
+    day 2) of each measure, and save them as a TAB delimited table.
+    Subjects are resampled from the whole table and then only
+    the ones with usable values are counted for each measure.
+    INPUT:      data (WorkingTable, eg: from process)
+                bootstrap_filename
+                n_boot (number of resamples)
+                seed (for the random number generator)
+                alpha (the confidence intervals are 100 * (1 - alpha)%)
+    '''
+    layout = data.layout
+    days = layout['days']
+
+    names = []
+    stats = []
+    for occasion in layout['occasions']:
+        for measure in layout['measures']:
+            av_name = '{occ}_av_{time}cortisol'.format(occ=occasion, time=measure)
+            names.append(av_name)
+
+            # For the mean: n and x
+            w = define_usable_mask(data, av_name) * 1.
+            x = np.where(w > 0, data[av_name], 0.)
+            stats.extend([ w, x ])
+
+            # For the reliability: n, x, y, x^2, y^2 and xy for the
+            # subjects with usable values on both of the first two days
+            if len(days) > 1:
+                d1_name = '{occ}_d{day}_{time}cortisol'.format(occ=occasion, day=days[0], time=measure)
+                d2_name = '{occ}_d{day}_{time}cortisol'.format(occ=occasion, day=days[1], time=measure)
+                w = (define_usable_mask(data, d1_name) & define_usable_mask(data, d2_name)) * 1.
+                x = np.where(w > 0, data[d1_name], 0.)
+                y = np.where(w > 0, data[d2_name], 0.)
+            else:
+                w = x = y = np.zeros(data['ID'].shape)
+            stats.extend([ w, x, y, x * x, y * y, x * y ])
+
+    # Each measure has 8 rows of stats
+    stats = np.vstack(stats)
+    sums = np.dot(stats, np.ones(stats.shape[1])).reshape(len(names), 8)
+    if stats.shape[1] < 2:
+        # You can't resample fewer than 2 subjects so all
+        # the intervals (and correlations) are nans
+        print 'Fewer than 2 subjects so the bootstrap intervals are all nan'
+        boot_sums = np.empty((n_boot, len(names), 8))
+        boot_sums.fill(np.nan)
+    else:
+        boot_sums = bootstrap_sums(stats, n_boot, seed).reshape(n_boot, len(names), 8)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums[:, 1] / sums[:, 0]
+        boot_means = boot_sums[:, :, 1] / boot_sums[:, :, 0]
+    reliability = calculate_correlation(sums[:, 2:])
+    boot_reliability = calculate_correlation(boot_sums[:, :, 2:])
+
+    percentiles = [ 100 * alpha / 2, 100 * (1 - alpha / 2) ]
+    with warnings.catch_warnings():
+        # (Measures nobody has values for are all nans)
+        warnings.simplefilter('ignore', RuntimeWarning)
+        means_ci = np.nanpercentile(boot_means, percentiles, axis=0)
+        reliability_ci = np.nanpercentile(boot_reliability, percentiles, axis=0)
+    # (and don't give intervals for correlations we can't calculate)
+    reliability_ci[:, np.isnan(reliability)] = np.nan
+
+    out_names = [ 'measure', 'N', 'mean', 'mean_ci_low', 'mean_ci_high',
+                    'N_reliability', 'reliability', 'reliability_ci_low', 'reliability_ci_high' ]
+    out_columns = [ np.array(names + [ '' ])[:-1],
+                    sums[:, 0].astype(int), means, means_ci[0], means_ci[1],
+                    sums[:, 2].astype(int), reliability, reliability_ci[0], reliability_ci[1] ]
+
+    write_table(out_names, out_columns, bootstrap_filename)
 #--------------------------------------------------------------------
-# Define some variables
-try:
-    data_filename = sys.argv[1]
-    selection_criteria_name = sys.argv[2]
-    output_filename = sys.argv[3]
-except:
-    print 'Check your input files'
-    usage()
-    sys.exit()
 
+class StageProfiler(object):
+    '''
+    Keeps track of how long each stage of the pipeline takes
+    and how much memory it uses.
+    For each stage it records:
+        wall_time       seconds on the clock
+        cpu_time        seconds of CPU (user + system) used by
+                            this process
+        rss_start_mb    memory (resident set size) in MB when
+                            the stage starts
+        rss_end_mb      and when it finishes
+        rss_change_mb   how much the memory went up (or down)
+        stage_peak_rss_mb   the most memory used during the stage
+                            (the high water mark is reset before
+                            each stage so earlier stages don't count)
+        process_peak_rss_mb the most memory the whole process has
+                            used so far
+        rows, columns   the size of the data that the stage returns
+    The memory numbers are None if we can't find them out
+    (the stage ones come from /proc so they only work on Linux)
+    If stats_basename is given each stage is also run under cProfile
+    and the stats are saved to {stats_basename}_{stage}.prof
+    '''
+    def __init__(self, stats_basename=None):
+        self.stats_basename = stats_basename
+        self.stages = []
+
+    def run(self, name, function, *args, **kwargs):
+        '''
+        Run function(*args, **kwargs) as the stage called name
+        and return whatever it returns
+        '''
+        rss_start = measure_rss('VmRSS')
+        peak_reset = reset_peak_rss()
+        wall_start = time.time()
+        cpu_start = sum(os.times()[:2])
+
+        if self.stats_basename:
+            profile = cProfile.Profile()
+            result = profile.runcall(function, *args, **kwargs)
+            profile.dump_stats('{base}_{name}.prof'.format(base=self.stats_basename, name=name))
+        else:
+            result = function(*args, **kwargs)
+
+        stage = OrderedDict()
+        stage['name'] = name
+        stage['wall_time'] = time.time() - wall_start
+        stage['cpu_time'] = sum(os.times()[:2]) - cpu_start
+        stage['rss_start_mb'] = rss_start
+        stage['rss_end_mb'] = measure_rss('VmRSS')
+        if rss_start is None or stage['rss_end_mb'] is None:
+            stage['rss_change_mb'] = None
+        else:
+            stage['rss_change_mb'] = stage['rss_end_mb'] - rss_start
+        stage['stage_peak_rss_mb'] = measure_rss('VmHWM') if peak_reset else None
+        stage['process_peak_rss_mb'] = measure_peak_rss()
+        stage['rows'], stage['columns'] = measure_table_size(result)
+        self.stages.append(stage)
+
+        return result
+
+    def save(self, profile_filename):
+        '''
+        Save all the stages (in the order they were run) to a JSON file
+        '''
+        profile = OrderedDict()
+        profile['stages'] = self.stages
+        profile['total_wall_time'] = sum([ stage['wall_time'] for stage in self.stages ])
+        profile['total_cpu_time'] = sum([ stage['cpu_time'] for stage in self.stages ])
+        profile['process_peak_rss_mb'] = measure_peak_rss()
+
+        with open(profile_filename, 'w') as f:
+            json.dump(profile, f, indent=4)
 #--------------------------------------------------------------------
-# Import data
-data, measure_dict = import_data(data_filename)
 
+def measure_peak_rss():
+    '''
+    The most memory this process has used so far in MB
+    (or None if the resource module isn't there, eg on Windows)
+    '''
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports this in KB but Macs report it in bytes
+    if platform.system() == 'Darwin':
+        return peak_rss / (1024. * 1024.)
+    return peak_rss / 1024.
 #--------------------------------------------------------------------
-# Run the CortisolSelectionCriteria.py script
-# This will import your various selection criteria
-execfile(selection_criteria_name)
 
-# If you have a sublist filter on then keep only those subjects
-if filter_subs:
-    os.path.isfile(include_subs_list)
+def measure_rss(field):
+    '''
+    A memory number (eg: VmRSS for the memory being used right now
+    or VmHWM for the most since it was last reset) from
+    /proc/self/status in MB (or None if it isn't there, eg on a Mac)
+    '''
     try:
-        include_subs_file = include_subs_list
-    except:
-        include_subs_file = ' '
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    # The number is always in kB
+                    return int(line.split()[1]) / 1024.
+    except IOError:
+        pass
+    return None
+#--------------------------------------------------------------------
+
+def reset_peak_rss():
+    '''
+    Reset the high water mark (VmHWM) to the memory being used
+    right now so it only counts what happens from here on.
+    Returns False if we can't (it needs Linux 4.0 or later)
+    '''
     try:
-        exclude_subs_file = exclude_subs_list
-    except:
-        exclude_subs_file = ' '
-        
-    data = keep_filter_subs(data, include_subs_file, exclude_subs_file)
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        return False
+    return True
+#--------------------------------------------------------------------
+
+def measure_table_size(result):
+    '''
+    The number of rows and columns in whatever a stage returns
+    (None if it isn't a table)
+    '''
+    if isinstance(result, tuple) and result:
+        result = result[0]
+    if isinstance(result, np.ndarray) and result.dtype.names:
+        return result.shape[0], len(result.dtype.names)
+    if isinstance(result, dict) and 'ID' in result:
+        return result['ID'].shape[0], len(result)
+    return None, None
+#--------------------------------------------------------------------
+
+def run_stage(profiler, name, function, *args, **kwargs):
+    '''
+    Run one stage of the pipeline (through the profiler if you've
+    got one)
+    '''
+    if profiler is None:
+        return function(*args, **kwargs)
+    return profiler.run(name, function, *args, **kwargs)
+#--------------------------------------------------------------------
+
+def process(data, criteria, layout=None, profiler=None):
+    '''
+    Run the whole pipeline on one set of data with one set of
+    selection criteria. Nothing is saved and the data you pass
+    in isn't changed so you can call this as often as you like.
+    INPUT:      data (recarray, eg: from import_data)
+                criteria (dictionary of the answers to the selection
+                            criteria questions, eg: from
+                            read_selection_criteria)
+                layout (optional, from define_layout)
+                profiler (optional StageProfiler that times each stage)
+    RETURNS:    table (WorkingTable of column name: array)
+    '''
+    if layout is None:
+        layout = define_layout(data.dtype.names)
+
+    # If you have a sublist filter on then keep only those subjects
+    if criteria['filter_subs']:
+        data = run_stage(profiler, 'keep_filter_subs', keep_filter_subs, data,
+                                criteria.get('include_subs_list', ' '),
+                                criteria.get('exclude_subs_list', ' '))
+
+    if criteria['excl_med']:
+        data = run_stage(profiler, 'excl_med_subs', excl_med_subs, data,
+                                criteria['medlist_file'],
+                                criteria['medlist_special_cases_file'])
+
+    #----------------------------------------------------------------
+    # Set up the working table that all the new columns are written into
+    table = run_stage(profiler, 'create_working_table', create_working_table, data, layout)
+
+    #----------------------------------------------------------------
+    # Write in the selection columns
+    table = run_stage(profiler, 'write_selection_columns', write_selection_columns, table, criteria)
+
+    #----------------------------------------------------------------
+    # Run the various compare columns:
+    #   Compare within day:
+    #       maxam cortisol measure for separate days
+    #       cortisol awakening response
+    #       dayav
+    #       dayrange
+    table = run_stage(profiler, 'run_comparisons_within_day', run_comparisons_within_day, table, criteria)
+    #   Compare across days:
+    #       regular measures across days (t1 + t2) / 2
+    #       maxan and cortisol across days (t1 + t2) / 2
+    #       dayav
+    #       dayrange
+    table = run_stage(profiler, 'run_comparisons_across_day', run_comparisons_across_day, table)
+
+    return table
+#--------------------------------------------------------------------
+
+def hash_rows(data):
+    '''
+    A hash of every row of the input data (so we can tell which
+    subjects have changed since the last time)
+    The values are hashed rather than the raw bytes so it doesn't
+    matter if the columns are a bit wider in the new data file
+    '''
+    return np.array([ hashlib.sha1(repr(row)).hexdigest() for row in data.tolist() ])
+#--------------------------------------------------------------------
 
-if excl_med:
-    data = excl_med_subs(data, medlist_file, medlist_special_cases_file)
+def define_state_key(data, criteria):
+    '''
+    A key for everything (apart from the rows themselves) that
+    changes the output: the selection criteria settings, the
+    subject and medication lists they point to, the input
+    column names and the code in this file
+    If any of these change the whole data set is reprocessed
+    '''
+    sha = hashlib.sha1()
+    sha.update(inspect.getsource(sys.modules[__name__]))
+    sha.update(repr(list(data.dtype.names)))
+
+    settings = sorted([ (key, value) for key, value in criteria.items()
+                            if isinstance(value, (bool, int, float, str, list, tuple)) ])
+    sha.update(repr(settings))
+
+    for setting in [ 'include_subs_list', 'exclude_subs_list',
+                        'medlist_file', 'medlist_special_cases_file' ]:
+        for filename in define_sublist_filenames(criteria.get(setting, ' ')):
+            if os.path.isfile(filename):
+                with open(filename, 'rb') as f:
+                    sha.update(f.read())
+
+    return sha.hexdigest()
+#--------------------------------------------------------------------
+
+def load_state(state_filename, key):
+    '''
+    Read in the state saved by the last incremental run
+    RETURNS:    state (dictionary of the input_ids, row_hashes,
+                        names and columns of the table) or None
+                        if there isn't one or it was made with
+                        different settings (see define_state_key)
+    '''
+    if not os.path.isfile(state_filename):
+        return None
+
+    saved = np.load(state_filename)
+    if not str(saved['key']) == key:
+        return None
+
+    names = saved['names'].tolist()
+    state = {   'input_ids': saved['input_ids'],
+                'row_hashes': saved['row_hashes'],
+                'names': names,
+                'columns': [ saved['column_{i}'.format(i=i)] for i in xrange(len(names)) ] }
+
+    return state
 #--------------------------------------------------------------------
-# Write in the selection columns
-data = write_selection_columns(data, measure_dict)
 
+def save_state(state_filename, key, input_ids, row_hashes, table):
+    '''
+    Save everything the next incremental run needs: the key, the
+    IDs and row hashes of all the input data (including the subjects
+    that were filtered out) and all the columns of the table
+    '''
+    names = table.keys()
+    columns = dict([ ('column_{i}'.format(i=i), table[name]) for i, name in enumerate(names) ])
+
+    # Save to a temporary file and then move it into place so a
+    # half written state file is never read
+    temp_filename = state_filename + '.{pid}.tmp'.format(pid=os.getpid())
+    with open(temp_filename, 'wb') as f:
+        np.savez(f, key=np.array(key), input_ids=input_ids, row_hashes=row_hashes,
+                    names=np.array(names), **columns)
+    os.rename(temp_filename, state_filename)
 #--------------------------------------------------------------------
-# Run the various compare columns:
-#   Compare within day:
-#       maxam cortisol measure for separate days
-#       cortisol awakening response
-#       dayav
-#       dayrange
-data = run_comparisons_within_day(data, measure_dict)
-#   Compare across days:
-#       regular measures across days (t1 + t2) / 2
-#       maxan and cortisol across days (t1 + t2) / 2
-#       dayav
-#       dayrange
-data = run_comparisons_across_day(data, measure_dict)
 
+def process_incremental(data, criteria, state_filename, layout=None, profiler=None):
+    '''
+    Does the same thing as process but only for the subjects
+    who are new (or whose data has changed) since the last time
+    it was run with the same state file. Their results are merged
+    with the saved results for everyone else so the table is
+    exactly what process would give you for the whole data set.
+    If the settings have changed (see define_state_key) or the IDs
+    aren't unique then everyone is processed again.
+    INPUT:      data (recarray, eg: from import_data)
+                criteria (dictionary of the selection criteria answers)
+                state_filename (where to keep the results between runs)
+                layout (optional, from define_layout)
+                profiler (optional StageProfiler, see process)
+    RETURNS:    table (WorkingTable of column name: array)
+    '''
+    if layout is None:
+        layout = define_layout(data.dtype.names)
+
+    key = define_state_key(data, criteria)
+    input_ids = np.asarray(data['ID'])
+    row_hashes = hash_rows(data)
+
+    state = None
+    if np.unique(input_ids).shape[0] == input_ids.shape[0]:
+        state = load_state(state_filename, key)
+
+    if state is None:
+        changed = np.ones(input_ids.shape)==1
+        old_table = WorkingTable(layout)
+    else:
+        old_hashes = dict(zip(state['input_ids'].tolist(), state['row_hashes'].tolist()))
+        changed = np.array([ not old_hashes.get(sub_id) == row_hash
+                                for sub_id, row_hash in zip(input_ids.tolist(), row_hashes.tolist()) ],
+                                dtype=bool)
+        old_table = WorkingTable(layout)
+        for name, column in zip(state['names'], state['columns']):
+            old_table[name] = column
+
+    print 'Processing {n} new or changed subjects (of {total})'.format(n=np.sum(changed),
+                                                                        total=changed.shape[0])
+    new_table = process(data[changed], criteria, layout, profiler)
+
+    # Now work out where each row of the table comes from
+    # Subjects who have changed come from the new table and everyone
+    # else from the old one (but only if they made it through the
+    # filters last time). The rows stay in the same order as the input.
+    n_old = old_table['ID'].shape[0] if 'ID' in old_table else 0
+    row_lookup = dict(zip(old_table['ID'].tolist(), xrange(n_old))) if n_old else dict()
+    row_lookup_new = dict(zip(new_table['ID'].tolist(), xrange(n_old, n_old + new_table['ID'].shape[0])))
+
+    rows = []
+    for sub_id, is_changed in zip(input_ids.tolist(), changed.tolist()):
+        lookup = row_lookup_new if is_changed else row_lookup
+        if sub_id in lookup:
+            rows.append(lookup[sub_id])
+    rows = np.array(rows, dtype=int)
+
+    table = WorkingTable(layout)
+    for name in new_table.keys():
+        if n_old:
+            column = np.concatenate([ old_table[name], new_table[name] ])
+        else:
+            column = new_table[name]
+        table[name] = column[rows]
+
+    save_state(state_filename, key, input_ids, row_hashes, table)
+
+    return table
 #--------------------------------------------------------------------
-# Run the data reporting function
-data_report(data, criteria_title)
 
+def main(argv):
+    '''
+    Run the main body of the script
+    '''
+    #----------------------------------------------------------------
+    # Define some variables
+    # Anything that starts with -- is an option, everything else
+    # is one of the input arguments
+    options = [ arg for arg in argv[1:] if arg.startswith('--') ]
+    arguments = [ arg for arg in argv[1:] if not arg.startswith('--') ]
+    try:
+        data_filename = arguments[0]
+        selection_criteria_name = arguments[1]
+        output_filename = arguments[2]
+    except:
+        print 'Check your input files'
+        usage()
+        sys.exit()
+
+    #----------------------------------------------------------------
+    # If you want to know where the time goes then set up the profiler
+    # (--profile-stats also saves the cProfile stats for each stage)
+    output_basename = os.path.splitext(output_filename)[0]
+    profiler = None
+    if '--profile' in options or '--profile-stats' in options:
+        stats_basename = None
+        if '--profile-stats' in options:
+            stats_basename = output_basename + '_profile'
+        profiler = StageProfiler(stats_basename)
+
+    #----------------------------------------------------------------
+    # Import data
+    data, layout = run_stage(profiler, 'import_data', import_data, data_filename,
+                                use_cache=not '--no-cache' in options)
+
+    #----------------------------------------------------------------
+    # Run the CortisolSelectionCriteria.py script
+    # This will import your various selection criteria
+    criteria = read_selection_criteria(selection_criteria_name)
+
+    # If you want to see what happens with every possible combination
+    # of the selection criteria then do that now (before any subjects
+    # are filtered out)
+    if '--sweep' in options or '--sweep-averages' in options:
+        averages_filename = None
+        if '--sweep-averages' in options:
+            averages_filename = output_basename + '_sweep_averages.txt'
+        run_stage(profiler, 'criteria_sweep', criteria_sweep, data, layout, criteria,
+                        output_basename + '_sweep.txt',
+                        averages_filename)
+
+    #----------------------------------------------------------------
+    # Run all the selection criteria and comparisons
+    # (only for the new or changed subjects if this is an incremental run)
+    if '--incremental' in options:
+        state_filename = output_basename + '_state.npz'
+        table = process_incremental(data, criteria, state_filename, layout, profiler)
+    else:
+        table = process(data, criteria, layout, profiler)
+
+    #----------------------------------------------------------------
+    # Run the data reporting function
+    # (unless you don't want any figures)
+    # The figure is drawn in a separate process while the data is saved
+    # (apart from when you're profiling so that its time is counted)
+    report_process = None
+    if not '--no-figures' in options:
+        fig_filename = output_basename + '.png'
+        report_process = run_stage(profiler, 'data_report', data_report,
+                                        table, criteria['criteria_title'], fig_filename,
+                                        background=profiler is None)
+
+    #----------------------------------------------------------------
+    # Save the data
+    run_stage(profiler, 'data_save', data_save, table, output_filename,
+                sidecar='--sidecar' in options)
+
+    # And the summary of why measures were excluded
+    if '--flags' in options:
+        run_stage(profiler, 'flags_save', flags_save, table, output_basename + '_flags.txt')
+
+    # And the bootstrap confidence intervals
+    # (--bootstrap=1000 for a different number of resamples)
+    bootstrap_options = [ option for option in options if option.split('=')[0] == '--bootstrap' ]
+    if bootstrap_options:
+        n_boot = 10000
+        if '=' in bootstrap_options[0]:
+            n_boot = int(bootstrap_options[0].split('=')[1])
+        run_stage(profiler, 'bootstrap_save', bootstrap_save, table,
+                    output_basename + '_bootstrap.txt', n_boot)
+
+    # Wait for the figure to finish
+    if report_process is not None:
+        report_process.join()
+        if not report_process.exitcode == 0:
+            print 'Something went wrong making the figure: {fig}'.format(fig=fig_filename)
+
+    # And save the profile
+    if profiler is not None:
+        profiler.save(output_basename + '_profile.json')
 #--------------------------------------------------------------------
-# Save the data
-data_save(data, output_filename)
+
+#====================================================================
+# MAIN CODE
+#====================================================================
+# Only run the main body of the script if it's being run
+# (rather than imported)
+if __name__ == '__main__':
+    main(sys.argv)
 
 #--------------------------------------------------------------------
 
@@ -778,4 +2003,4 @@ data_save(data, output_filename)
 Today is Lily Farris' 30th birthday! HAPPY BIRTHDAY LILY!
 Miss you, love you
 Kx
-'''
\ No newline at end of file
+'''
@@ -25,6 +25,13 @@ but don't have a filelist of subjects to *include* then you can set:
     include_subs_list = ' '
     exclude_subs_list = '/work/imagingA/mrimpact/workspaces/CORTISOL/exclude_subjects.txt'
 
+If you have more than one list you can give them all in square brackets.
+Subjects are kept if they're in ANY of the include lists and not in ANY
+of the exclude lists. For example:
+
+    include_subs_list = [ '/work/imagingA/mrimpact/workspaces/CORTISOL/MRIMPACT_subs.txt',
+                            '/work/imagingA/mrimpact/workspaces/CORTISOL/extra_subs.txt' ]
+
 '''
 
 #------------------------------------------------------------------------------
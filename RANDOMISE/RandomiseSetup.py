@@ -33,11 +33,22 @@ from shutil import copy
 import itertools as it
 import numpy.lib.recfunctions as nprf
 from glob import glob
+import hashlib
+from collections import OrderedDict
+import multiprocessing
 
 # Import your personal scripts
 sys.path.insert(0, '/home/kw401/CAMBRIDGE_SCRIPTS/GENERAL_SCRIPTS/')
 sys.path.insert(0, 'C:\\Users\\Kirstie\\Dropbox\\GitHub\\GENERAL_CODE\\')
 import MyCoolFunctions as mcf
+
+# The subject lists are read (and the data cached) the same way as
+# in Cortisol_PreProcessing.py (see SHARED/SubjectLists.py and SHARED/DataCache.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    os.pardir, 'SHARED'))
+from SubjectLists import read_subject_set
+from DataCache import load_cached_data
+from MergeTables import merge_tables
 #------------------------------------------------
 
 #------------------------------------------------
@@ -53,18 +64,45 @@ def usage():
     Output: Text to terminal
     """
     
-    print 'Randomise_setup.py <behav_file> <cortisol_file> <randomise_setup.py file> <usable_mri_sublist_file> <output_directory> '
+    print 'Randomise_setup.py <behav_file> <cortisol_file> <randomise_setup.py file> <usable_mri_sublist_file> <output_directory> [options]'
     print '    <behav_file>: TAB delimited behavioral data with header'
     print '    <cortisol_file>: TAB delimited file with cortisol data'
     print '                     probably output from Cortisol_PreProcessing.py'
     print '    <randomise_setup.py file>: randomise file that contains your personal options'
     print '    <useable_mri_sublist_file>: list of subids to be included in analyses'
     print '    <output_directory>: Name (and path) of output directory'
+    print '    Options:'
+    print '        --no-cache: always read the text files rather than using the binary'
+    print '                    cache in the .cache directory next to them'
+    print '        --merge <file>: also merge the columns from this TAB delimited'
+    print '                        file (eg: questionnaires or scanner QC) by SubID'
+    print '                        You can give --merge more than once'
+    print '        --min-subjects N: prune designs with fewer than N subjects'
+    print '                          (in either group for the TTests, default 10)'
+    print '        --max-cond N: flag designs whose condition number is more than N'
+    print '                      (default 30)'
+    print '        --jobs N: create the design files for N groups at a time'
+    print '                  (default is 1, one group after another)'
+    print '                  This needs fork so it\'s ignored on Windows'
+    print '        --plan: don\'t write anything, just list the designs that would'
+    print '                be written and estimate how long randomise will take'
+    print '        --perms N: number of permutations for the --plan estimate (default 5000)'
+    print '        --voxels N: number of skeleton voxels for the --plan estimate'
+    print '                    (default 120000)'
     print '\teg: Randomise_DTIROIS_setup.py BehavData_130321.csv dti_sublist TBSS_120314'
 
 #------------------------------------------------
-def setup_data(behav_filename):
-    data = np.genfromtxt(behav_filename, dtype=None, names=True, delimiter='\t')
+def read_tab_file(filename):
+    """
+    Read in a TAB delimited file with a header
+    """
+    data = np.genfromtxt(filename, dtype=None, names=True, delimiter='\t')
+    return data
+
+#------------------------------------------------
+def setup_data(behav_filename, use_cache=True):
+    data = load_cached_data(behav_filename, read_tab_file,
+                                use_cache=use_cache, write_cache=not plan_only)
     
     ### SUBID
     # Create a SubID column that is just the subid without the letter M
@@ -106,28 +144,48 @@ def setup_data(behav_filename):
     
     return data
 
-def merge_cort(data, cortisol_filename):
-    
-    cort_data = np.genfromtxt(cortisol_filename, dtype=None, names=True, delimiter='\t')
-    
-    names = list(cort_data.dtype.names)
+def merge_cort(data, cortisol_filename, aux_filenames=[], use_cache=True):
+    """
+    Merge the cortisol measures (and all the columns from any other
+    tables, eg: questionnaires or scanner QC) into data by SubID.
+    Anyone who isn't in a table gets 999s for its columns
+    ('' if it's a column of strings).
+    Columns that are already in data get the name of their
+    file on the end (see merge_tables).
     
-    # Find all the columns in cort_data that have 'av' in their title
-    # and not '_mask'
-    drop_names = names[8:]
+    Inputs:
+        data                Rec array from setup_data
+        cortisol_filename   TAB delimited cortisol file
+                                probably output from Cortisol_PreProcessing.py
+        aux_filenames       List of other TAB delimited files, each
+                                with a SubID column
+        use_cache           If False don't use the .cache directory
+    """
+    tables = []
+    for filename in [ cortisol_filename ] + aux_filenames:
+        aux_data = load_cached_data(filename, read_tab_file,
+                                        use_cache=use_cache, write_cache=not plan_only)
+        # We can't join a table that doesn't have a SubID column
+        if not 'SubID' in aux_data.dtype.names:
+            raise ValueError('There\'s no SubID column in {filename}'.format(filename=filename))
+
+        if filename == cortisol_filename:
+            # The cortisol measures are the columns whose names end in Cort
+            # (eg: WakeCort, CARCort or FuWakeCort for a follow up occasion)
+            names = [ name for name in aux_data.dtype.names if name.endswith('Cort') ]
+        else:
+            # Everything from the other tables (apart from the SubID)
+            names = [ name for name in aux_data.dtype.names if not name == 'SubID' ]
 
-    cort_data = nprf.drop_fields(cort_data, drop_names, usemask=False, asrecarray=True)
+        # Label the table with its file name (without the extension)
+        label = os.path.splitext(os.path.basename(filename))[0]
+        tables.append((aux_data, names, label))
     
-    data = nprf.join_by('SubID', data, cort_data, jointype='leftouter',
-                            r1postfix='KW', r2postfix='KW2', usemask=False,asrecarray=True)
-    
-    # Bizzarely, the join_by function pads with the biggest numbers it can think of!
-    # So we're going to replace everything over 999 with 999
-    for name in names[1:8]:
-        data[name][data[name]>999] = 999
+    data, table_names = merge_tables(data, tables)
+    cort_names = table_names[0]
     
     # Define a UsableCort field: 1 if ANY of the cortisol values are not 999
-    cort_array = np.vstack( [ data[name] for name in names[1:8]])
+    cort_array = np.vstack( [ data[name] for name in cort_names ])
     usable_cort_array = np.ones(cort_array.shape[1])
     usable_cort_array[np.any(cort_array<>999, axis=0)] = 1
     
@@ -152,17 +210,15 @@ def create_mask_all(data, usable_mri_subs):
     """
     This function excludes people who have abnormal brains or braces
     and only includes participants who have usable MRI data
+    (usable_mri_subs is a set of subject IDs from read_subject_set)
     """
     # Only include data for people who do not have abnormal brains or braces
     ab_brain_mask = data['AbnormalBrain']==0
     braces_mask = data['Braces']==0
 
     # Only include subs who have usable mri data
-    '''
-    AMAAAAZING tip here - np.in1d
-    stolen from http://stackoverflow.com/questions/13629061/numpy-mask-based-on-if-a-value-is-in-some-other-list
-    '''
-    mri_mask = np.in1d(data['SubID'], usable_mri_subs)
+    # (looking each one up in the set)
+    mri_mask = np.array([ sub_id in usable_mri_subs for sub_id in data['SubID'].tolist() ], dtype=bool)
 
     # Generate an overall mask
     mask_all = ab_brain_mask * braces_mask * mri_mask
@@ -181,22 +237,101 @@ def create_mask_all(data, usable_mri_subs):
 
 #------------------------------------------------
 
+# The rows of each column that aren't 999 (see excl_999s)
+# The data doesn't change once it's been read in so
+# these only need to be worked out once
+not_999_cache = dict()
+
 def excl_999s(data, measure, combo, mask):
     all_vars = []
     if not measure == '':
         all_vars.append(measure)
     all_vars.extend(combo)
     if not all_vars == []:
-        all_var_array = np.vstack([ data[var] for var in all_vars ])
+        for var in all_vars:
+            if not var in not_999_cache:
+                not_999_cache[var] = data[var]<>999
         # Mask any rows that have a value of 999
-        all_var_mask = np.all(all_var_array<>999, axis=0)
+        all_var_mask = np.logical_and.reduce([ not_999_cache[var] for var in all_vars ])
         mask = mask * all_var_mask
     
     return data, mask
 
+# The digest of the subject list for each directory that already
+# has its subs and subs_t1 files (see write_files)
+subs_digests = dict()
+
+# write_files doesn't write the .mat and .con files straight away,
+# it adds each design to the designs list as
+# (dir, test_name, n_subjects, n_evs, n_contrasts, digest, mat_text, con_text, matrix)
+# where matrix is the n_subjects x n_evs design matrix, and then
+# check_designs looks for broken designs and write_designs writes
+# the rest at the end so that designs that are exactly the same
+# are only written once.
+# If we're only planning (see --plan) nothing is written at all.
+plan_only = False
+designs = []
+
+def has_empty_column(mat_array):
+    """
+    Check whether any of the EVs in the mat array are all the same
+    (eg: Controls and Meds -- the Meds column will be all 0s)
+    because those designs don't get written out
+    ndim is the number of dimensions that the array has
+    but we need to index from 1 below that
+    """
+    if mat_array.ndim == 1:
+        return mat_array.std() == 0.0
+    return 0.0 in mat_array.std(axis=mat_array.ndim-1)
+
+def design_size(mat_array):
+    """
+    Return the number of EVs (waves) and the number of
+    subjects (points) in a mat array
+    """
+    if mat_array.ndim == 1:
+        return 1, mat_array.shape[0]
+    return mat_array.shape[0], mat_array.shape[1]
+
+def format_design_matrix(array, fmt):
+    """
+    Turn an array into the same text that np.savetxt(filename, array, fmt=fmt)
+    would write (one row per line, columns separated by spaces)
+    so that we can put the header on the front and write the
+    whole file in one go
+    """
+    array = np.asarray(array)
+    if array.ndim == 1:
+        array = array[:, None]
+    row_format = ' '.join([ fmt ] * array.shape[1]) + '\n'
+    return ''.join([ row_format % tuple(row) for row in array ])
+
+def digest_design(subs_digest, test_name, mat_text, con_text):
+    """
+    A key for everything randomise sees for a design: the subjects,
+    the .mat and .con files and whether RunningRandomise.sh demeans
+    the data (it doesn't for the TTests). Two designs with the same
+    key give exactly the same results.
+    """
+    sha = hashlib.sha1()
+    sha.update(subs_digest)
+    sha.update(str(test_name.startswith('TTest')))
+    sha.update(mat_text)
+    sha.update('\0')
+    sha.update(con_text)
+    return sha.hexdigest()
+
+def write_design_file(filename, text):
+    """
+    Write a whole design file with just one write
+    """
+    with open(filename, 'w') as f:
+        f.write(text)
+
 def write_files(subs_array, mat_array, con_array, test_name, dir):
     """
-    Writes out .mat, .con and subs design files
+    Writes out the subs design files and adds the .mat and .con files
+    to the designs list (write_designs writes those out)
     
     Inputs:
         subs_array      List of subIDs to be written out
@@ -209,78 +344,263 @@ def write_files(subs_array, mat_array, con_array, test_name, dir):
         Files saved in locations specified by filenames:
         subs file       List of sub ids (just the 4 digit number)
         subs_t1_file    List of sub ids with t1 appended
-        mat_file        Mat file for FSL analyses
-        con_file        Con file for FSL analyses
+    The subs files are the same for every design in a directory
+    so they're only written the first time
     """
-    # Make sure output dir exists
-    mcf.KW_mkdirs(dir)
-    
     # Name the files
     subs_t1_filename = os.path.join(dir, 'subs_t1')
     subs_filename = os.path.join(dir, 'subs')
-    mat_filename = os.path.join(dir, test_name + '.mat')
-    con_filename = os.path.join(dir, test_name + '.con')
 
-    # Write out the subs with t1 appended to the subs_t1_filename
-    np.savetxt(subs_t1_filename, subs_array[mask], fmt = '%s')
-    
-    # Write out the subs ids alone to the subs filename
-    np.savetxt(subs_filename, data['SubID'][mask], fmt = '%s')
+    if not dir in subs_digests:
+        if not plan_only:
+            # Make sure output dir exists
+            mcf.KW_mkdirs(dir)
+
+            # Write out the subs with t1 appended to the subs_t1_filename
+            np.savetxt(subs_t1_filename, subs_array[mask], fmt = '%s')
+
+            # Write out the subs ids alone to the subs filename
+            np.savetxt(subs_filename, data['SubID'][mask], fmt = '%s')
+
+        subs_digests[dir] = hashlib.sha1(''.join([ str(sub) + '\n' for sub in subs_array[mask] ])).hexdigest()
     
     # Only save files if there are no empty colums
-    # (eg: Controls and Meds -- the Meds column will be all 0s)
-    # ndim is the number of dimensions that the array has
-    # but we need to index from 1 below that
-    if mat_array.ndim == 1:
-        test = mat_array.std() == 0.0
-    else:
-        test = 0.0 in mat_array.std(axis=mat_array.ndim-1)
-    if not test:
-        # Save the mat data
-        np.savetxt(mat_filename, mat_array.T, fmt = '%2.6f')
-
-        if mat_array.ndim == 1:
-            waves = 1
-            points = mat_array.shape[0]
-        else:
-            waves = mat_array.shape[0]
-            points = mat_array.shape[1]
-        # Now create the matrix header
-        '''
-        I stole how to do this from
-        http://www.gossamer-threads.com/lists/python/dev/736081
-        '''
-        # read the current contents of the file 
-        f = open(mat_filename)
-        text = f.read() 
-        f.close() 
-        # open the file again for writing
-        f = open(mat_filename, 'w') 
-        f.write('/NumWaves    ' + str(waves) + '\n')
-        f.write('/NumPoints    ' + str(points) + '\n')
-        f.write('/Matrix \n')
-        # write the original contents 
-        f.write(text) 
-        f.close() 
+    if not has_empty_column(mat_array):
+        waves, points = design_size(mat_array)
+
+        # Make the mat data with its header
+        mat_text = ( '/NumWaves    ' + str(waves) + '\n'
+                    + '/NumPoints    ' + str(points) + '\n'
+                    + '/Matrix \n'
+                    + format_design_matrix(mat_array.T, '%2.6f') )
         
         # Repeat for the contrast data
-        np.savetxt(con_filename, con_array, fmt = '%2.4f')
-        # Now write the header
-        # Read in the original data
-        f = open(con_filename)
-        text = f.read()
-        f.close()
-        # First the header
-        f = open(con_filename, 'w')
-        f.write('/NumWaves    ' + str(waves) + '\n')
-        f.write('/NumContrasts    ' + str(con_array.shape[0]) + '\n')
-        f.write('/Matrix \n')
-        # Now write in the original contents
-        f.write(text)
-        f.close()
+        con_text = ( '/NumWaves    ' + str(waves) + '\n'
+                    + '/NumContrasts    ' + str(con_array.shape[0]) + '\n'
+                    + '/Matrix \n'
+                    + format_design_matrix(con_array, '%2.4f') )
+
+        digest = digest_design(subs_digests[dir], test_name, mat_text, con_text)
+        matrix = np.atleast_2d(mat_array).T
+        designs.append((dir, test_name, points, waves, con_array.shape[0], digest, mat_text, con_text, matrix))
+
+def check_designs(group_designs, min_subjects, max_cond):
+    """
+    Find the designs that randomise can't do anything useful with
+    before any of them are written out. Designs are pruned if:
+        - their EVs aren't linearly independent (eg: Male in a
+          group that's been split on gender, once the group
+          columns are in there too)
+        - there are fewer than min_subjects subjects (or fewer
+          than min_subjects in either group for the TTests)
+        - there aren't more subjects than EVs
+        - there aren't any subjects at all
+    and they're flagged (but still written) if the condition number
+    is bigger than max_cond.
+    All the designs that are the same shape are checked at once:
+    each EV is scaled to length 1 (so the condition number doesn't
+    depend on the units of the variables) and then they're stacked
+    up and numpy works out all their singular values in one go.
+
+    Inputs:
+        group_designs   List of the designs for each group
+                            (see create_group)
+        min_subjects    Smallest number of subjects (in each group)
+        max_cond        Largest condition number before a design
+                            gets flagged
+
+    Output:
+        problems        Dictionary of (dir, test_name):
+                            (action, reason, rank, condition number)
+                            for every design that's pruned or flagged
+    """
+    all_designs = [ design for group_design in group_designs for design in group_design ]
+
+    # Designs with nobody in them are pruned straight away
+    # (there's nothing for the SVD to work on)
+    problems = dict()
+    shapes = dict()
+    for design in all_designs:
+        if design[8].shape[0] == 0:
+            problems[(design[0], design[1])] = ('pruned', 'no subjects', 0, np.inf)
+        else:
+            shapes.setdefault(design[8].shape, []).append(design)
+
+    for (n_subjects, n_evs), same_shape in shapes.items():
+        stack = np.array([ design[8] for design in same_shape ], dtype=float)
+        norms = np.sqrt((stack ** 2).sum(axis=1))
+        norms[norms == 0] = 1
+        stack = stack / norms[:, np.newaxis, :]
+
+        # The same rank and condition number as np.linalg.matrix_rank
+        # and np.linalg.cond but for the whole stack at once
+        singular_values = np.linalg.svd(stack, compute_uv=False)
+        s_max = singular_values[:, 0]
+        s_min = singular_values[:, -1]
+        tol = s_max * max(n_subjects, n_evs) * np.finfo(float).eps
+        ranks = (singular_values > tol[:, np.newaxis]).sum(axis=1)
+        with np.errstate(divide='ignore'):
+            conds = np.where(s_min > 0, s_max / s_min, np.inf)
+
+        for design, rank, cond in zip(same_shape, ranks, conds):
+            dir, test_name, matrix = design[0], design[1], design[8]
+
+            # The TTests need enough people in both groups
+            # (the first two EVs are the two groups)
+            if test_name.startswith('TTest'):
+                group_size = int(matrix[:, :2].sum(axis=0).min())
+            else:
+                group_size = n_subjects
+
+            reasons = []
+            if rank < n_evs:
+                reasons.append('rank {rank} with {evs} EVs'.format(rank=rank, evs=n_evs))
+            if group_size < min_subjects:
+                reasons.append('only {n} subjects'.format(n=group_size))
+            if n_subjects <= n_evs:
+                reasons.append('{n} subjects for {evs} EVs'.format(n=n_subjects, evs=n_evs))
+
+            if reasons:
+                action = 'pruned'
+            elif cond > max_cond:
+                action = 'flagged'
+                reasons.append('condition number {cond:.3g}'.format(cond=cond))
+            else:
+                continue
+            problems[(dir, test_name)] = (action, '; '.join(reasons), rank, cond)
+
+    return problems
+
+def write_pruning_report(group_designs, problems, report_filename):
+    """
+    Write out a TAB delimited report of all the designs that
+    check_designs pruned or flagged and why
+    """
+    with open(report_filename, 'w') as f:
+        f.write('\t'.join([ 'Group', 'TestName', 'Subjects', 'EVs', 'Rank', 'Condition', 'Action', 'Reason' ]) + '\n')
+        for group_design in group_designs:
+            for design in group_design:
+                dir, test_name, n_subjects, n_evs = design[:4]
+                if (dir, test_name) in problems:
+                    action, reason, rank, cond = problems[(dir, test_name)]
+                    f.write('\t'.join([ os.path.basename(dir), test_name, str(n_subjects), str(n_evs),
+                                        str(rank), '{cond:.3g}'.format(cond=cond), action, reason ]) + '\n')
+
+def write_designs(group_designs, manifest_filename, problems):
+    """
+    Write out the .mat and .con files for every design that hasn't been
+    pruned (see check_designs) and isn't exactly
+    the same as one that's already been written (eg: the Cort and IgCort
+    groups once everyone has cortisol data) and a manifest that lists
+    every design along with the model that was written for it.
+    RunningRandomise.sh then only runs randomise once for each model.
+    The designs are looked at in order so the model is always the
+    first one of the identical designs.
+
+    Inputs:
+        group_designs       List of the designs for each group
+                                (see create_group)
+        manifest_filename   TAB delimited file with a header:
+                                Group TestName ModelGroup ModelTestName Digest
+        problems            From check_designs
+    """
+    models = dict()
+    with open(manifest_filename, 'w') as f:
+        f.write('\t'.join([ 'Group', 'TestName', 'ModelGroup', 'ModelTestName', 'Digest' ]) + '\n')
+        for group_design in group_designs:
+            for dir, test_name, n_subjects, n_evs, n_contrasts, digest, mat_text, con_text, matrix in group_design:
+                if problems.get((dir, test_name), ('',))[0] == 'pruned':
+                    continue
+                if not digest in models:
+                    write_design_file(os.path.join(dir, test_name + '.mat'), mat_text)
+                    write_design_file(os.path.join(dir, test_name + '.con'), con_text)
+                    models[digest] = (dir, test_name)
+                model_dir, model_test_name = models[digest]
+                f.write('\t'.join([ os.path.basename(dir), test_name,
+                                    os.path.basename(model_dir), model_test_name, digest ]) + '\n')
 
 #------------------------------------------------
 
+# The demeaned blocks that have already been worked out
+# (see demeaned_block) with the most recently used at the end
+# mask digest: dictionary with the block, its rows and
+# the t-test columns (see ttest_columns)
+block_cache = OrderedDict()
+block_cache_size = 64
+
+def digest_mask(mask):
+    """
+    A short key for a mask (so the same subjects always
+    give the same key however the mask was made)
+    """
+    mask = np.asarray(mask, dtype=bool)
+    return hashlib.sha1(np.packbits(mask).tostring()).hexdigest() + str(mask.shape[0])
+
+def demeaned_block(data, mask, mask_digest):
+    """
+    All the measures and covars for the subjects in mask, each with
+    its mean taken away, in one block with a row for each variable.
+    Every combination of covariates (for every group and the t-tests)
+    just picks its rows out of the block so the columns are only
+    masked and demeaned once for each mask. The blocks are kept in
+    block_cache (the least recently used ones are thrown away once
+    there are more than block_cache_size of them)
+
+    Inputs:
+        data            The rec array that contains the data
+        mask            The subjects you want
+        mask_digest     From digest_mask(mask)
+
+    Output:
+        entry           Dictionary with the block (don't change it!),
+                            the row of the block for each variable
+                            and the t-test columns for this mask
+    """
+    if mask_digest in block_cache:
+        entry = block_cache.pop(mask_digest)
+    else:
+        variables = list(OrderedDict.fromkeys(measures + covars))
+        block = np.empty([len(variables), np.count_nonzero(mask)])
+        for i, variable in enumerate(variables):
+            block[i] = data[variable][mask]
+        block -= block.mean(axis=1)[:, np.newaxis]
+        entry = { 'block' : block,
+                  'rows' : dict((variable, i) for i, variable in enumerate(variables)),
+                  'ttest' : dict() }
+
+    block_cache[mask_digest] = entry
+    while len(block_cache) > block_cache_size:
+        block_cache.popitem(last=False)
+
+    return entry
+
+def ttest_columns(data, mask, mask_digest, index):
+    """
+    The two group columns for splitting on split_vars[index]
+    and their interactions with every measure at once
+    (kept with the demeaned block for this mask)
+
+    Output:
+        two_col         2 x n_subjects array of the two groups
+        interactions    Dictionary of the 2 x n_subjects
+                            interaction array for each measure
+    """
+    entry = demeaned_block(data, mask, mask_digest)
+    if not index in entry['ttest']:
+        col1 = data[split_vars[index]][mask]
+        col2 = (col1 * -1) + 1
+        two_col = np.vstack([col1, col2])
+
+        # Multiply the two columns by all the measures in one go
+        # (n_measures x 2 x n_subjects)
+        measure_rows = [ entry['rows'][measure] for measure in measures ]
+        interaction_block = two_col[np.newaxis, :, :] * entry['block'][measure_rows][:, np.newaxis, :]
+        interactions = dict(zip(measures, interaction_block))
+
+        entry['ttest'][index] = (two_col, interactions)
+
+    return entry['ttest'][index]
+
 def create_arrays(data, mask, measure, combo):
     """
     This function creates mat and con arrays and test_name
@@ -308,36 +628,33 @@ def create_arrays(data, mask, measure, combo):
     # because otherwise they aren't 999s anymore!!)
     data, mask = excl_999s(data, measure, combo, mask)
 
-    # If measure exists then create a var_array from
-    # the measure of interest and demean it
+    # The same columns come up again and again (for every
+    # combination of covariates, every group and the t-tests)
+    # so they're all demeaned once for each mask in one block
+    # and then we just pick out the rows we want
+    mask_digest = digest_mask(mask)
+    entry = demeaned_block(data, mask, mask_digest)
+    block = entry['block']
+    rows = entry['rows']
+
+    # If measure exists then var_array is the row
+    # for the (demeaned) measure of interest
     if measure:
-        var_array = data[measure][mask]
-        var_array = var_array - var_array.mean()
+        var_array = block[rows[measure]]
     
-    # If combo exists then create a covar_array from 
-    # the covariates of no interest
+    # If combo exists then covar_array is the rows for
+    # the (demeaned) covariates of no interest
     if combo:
-        # Stack together the covar data
         '''
         Another example of lovely list comprehension
         http://docs.python.org/2/tutorial/datastructures.html#list-comprehensions
         '''
-        covar_array = np.vstack([ data[covar][mask] for covar in combo ])
-        # Demean the columns
-        if covar_array.ndim == 1:
-            covar_array = covar_array - covar_array.mean()
-        else:
-            '''
-            This is a use of the [None] slicing - it adds a additional axis
-            so that the 1 dimensional means can be subtracted from the 
-            2 dimensional covar_array
-            '''
-            covar_array = covar_array - covar_array.mean(axis=1)[None].T
+        covar_array = block[[ rows[covar] for covar in combo ]]
         
-    # The mat array is just the stacking together of both of these arrays
+    # The mat array is just the rows for both of these
     # obviously depending on if you have them all etc
     if measure and combo:
-        mat_array = np.vstack([var_array, covar_array])
+        mat_array = block[[ rows[measure] ] + [ rows[covar] for covar in combo ]]
 
         test_name = 'Corr_' + measure
         covar_name = '_'.join(covar for covar in combo)
@@ -411,14 +728,17 @@ def create_arrays_ttest(mask, data, perm_list, index, measure, combo):
         combo       combination of addition covariates to include
                         but NOT test. Covariates of NO interest
     """
-    # Define the two column arrays - mask here
-    col1 = data[split_vars[index]][mask]
-    col2 = (col1 * -1) + 1
-    
-    ttest_array = np.vstack([col1, col2])
-
     # Use create_arrays function to create mat and con arrays
     corr_test_name, mat_array, con_array = create_arrays(data, mask, measure, combo)
+
+    # Define the two column arrays (and their interactions with
+    # all the measures) - these are the same for every combo so
+    # they're only worked out once for each mask
+    # (create_ttests has already taken out the 999s so create_arrays
+    # used this same mask)
+    two_col, interactions = ttest_columns(data, mask, digest_mask(mask), index)
+
+    ttest_array = two_col
         
     if measure or combo:
         # Append this mat_array to the ttest_array
@@ -451,14 +771,13 @@ def create_arrays_ttest(mask, data, perm_list, index, measure, combo):
     
     # Lastly - we have to create the interactions not just the
     # correlations
-    ttest_array_2col = np.vstack([col1, col2])
+    ttest_array_2col = two_col
     if measure:
+        interaction_array = interactions[measure]
         if combo:
-            interaction_array = ttest_array_2col * mat_array[0,:]
             ttest_array_2col = np.vstack([ttest_array_2col, interaction_array, mat_array[1:,:]])
 
         else:
-            interaction_array = ttest_array_2col * mat_array
             ttest_array_2col = np.vstack([ttest_array_2col, interaction_array])
         
         measure_name = '_Int_' + measure
@@ -519,16 +838,172 @@ def create_ttests(perm_list, dir, mask, data, subs_array):
                         
                         if measure:
                             write_files(subs_array, ttest_array_2col, con_array_2col, ttest_name_2col, dir)
+#------------------------------------------------
+def create_group(perm):
+    """
+    This function creates all the design files for one group,
+    which is one permutation of the 0,1,2 codes for the split_vars
+    (eg: perm is (1 2 1)).
+    It's run once for each group, either in a loop or in a pool
+    of worker processes (see the --jobs option).
+    Note that write_files looks at the global mask so this function
+    sets it rather than keeping its own copy.
+    It returns the designs that it added to the designs list
+    (see write_files) so they can be written out in order at the end.
+    """
+    global mask
+    start = len(designs)
+
+    # Write these names from the dictionary into a names list
+    '''
+    The j counter keeps the split_vars in the right position
+    and calls the appropriate values from the perm iterable
+    and calls the appropriate values from the perm iterable
+    j will always count from 0 to 2 because we've coded the
+    groups as 0, 1 and 2 in the dictionary
+    '''
+    names = [ group_dict[split_vars[j] + '_' + str(perm[j])] for j in range(len(split_vars)) ]
+
+    # Join the names all together
+    '''
+    '_' is the joining string
+    '''
+    group_dirname = '_'.join(name for name in names)
+    group_dir = os.path.join(glm_dir, group_dirname)
+
+    # Now create the mask you need for this data
+    # Initally mask is mask_all
+    mask = mask_all
+    for j in range(len(split_vars)):
+        '''
+        This is a pretty kickass awesome line of code that takes
+        advantage of list comprehensions
+        http://docs.python.org/2/tutorial/datastructures.html#list-comprehensions
+        It creates the split mask for each split_var (indexed by j)
+        (eg: split_vars[0] is 'Depressed') where it is equal to the
+        perm value (eg: if perm is (1 2 1) then the perm value for
+        'Depressed' (split_vars[0]) would be perm[0] --> 1)
+        So eg: mask asks where Depressed == 1
+        If the perm var is 2 it just keeps mask_all because 2 is used
+        to code "Ignore that measure for splitting"
+        '''
+        split_mask = np.array(data [split_vars[j]]==perm[j] if perm[j] < 2 else mask_all)
+        mask = mask * split_mask
+
+    # Don't do anything if the mask is empty
+    if mask.any():
+        # Create the correlation design files
+        create_correlations(group_dir, mask, data, subs_array)
+
+        # If you have two groups within this group then create t-tests
+        if 2 in list(perm):
+            perm_list = list(perm)
+            create_ttests(perm_list, group_dir, mask, data, subs_array)
+
+    return designs[start:]
+
+def read_number_option(options, name, default, number_type=int):
+    """
+    Return the number given for an option (eg: --jobs=4 gives 4)
+    or the default if the option isn't there
+    number_type is int for counts and float for thresholds
+    (eg: --max-cond=1e3)
+    """
+    values = [ opt.split('=', 1)[1] for opt in options if opt.startswith(name + '=') ]
+    if not values:
+        return default
+    try:
+        return number_type(values[-1])
+    except ValueError:
+        raise ValueError('{name} needs a number'.format(name=name))
+
+# The measures that RunningRandomise.sh runs randomise on for every design
+randomise_measures = [ 'FA', 'L1', 'L23', 'MD', 'MO' ]
+
+def print_plan(group_designs, problems, n_perms, n_voxels):
+    """
+    Print every design that would be written and an estimate of the
+    cost of running randomise on all of the different ones that
+    aren't pruned
+    (designs x measures x permutations x subjects x skeleton voxels)
+
+    Inputs:
+        group_designs   List of the designs for each group
+                            (see create_group)
+        problems        From check_designs
+        n_perms         Number of permutations
+        n_voxels        Number of voxels in the skeleton mask
+    """
+    print '\t'.join([ 'Group', 'TestName', 'Subjects', 'EVs', 'Contrasts', 'SameAs', 'Problem' ])
+    models = dict()
+    n_designs = 0
+    n_groups = 0
+    n_pruned = 0
+    total_subjects = 0
+    for group_design in group_designs:
+        if group_design:
+            n_groups += 1
+        for dir, test_name, n_subjects, n_evs, n_contrasts, digest, mat_text, con_text, matrix in group_design:
+            group = os.path.basename(dir)
+            action, reason, rank, cond = problems.get((dir, test_name), ('', '-', 0, 0))
+            if action:
+                reason = action + ': ' + reason
+            if action == 'pruned':
+                same_as = '-'
+                n_pruned += 1
+            elif digest in models:
+                same_as = models[digest]
+            else:
+                same_as = '-'
+                models[digest] = group + '/' + test_name
+                total_subjects += n_subjects
+            print '\t'.join([ group, test_name, str(n_subjects), str(n_evs), str(n_contrasts), same_as, reason ])
+            n_designs += 1
+
+    n_models = len(models)
+    n_runs = n_models * len(randomise_measures)
+    cost = float(total_subjects) * len(randomise_measures) * n_perms * n_voxels
+    print ''
+    print 'Designs: {designs} in {groups} groups, {pruned} pruned, {models} of the rest different'.format(
+                designs=n_designs, groups=n_groups, pruned=n_pruned, models=n_models)
+    print 'Randomise runs: {runs} ({models} different designs x {measures} measures)'.format(
+                runs=n_runs, models=n_models, measures=len(randomise_measures))
+    print 'Estimated cost: {cost:.3g} subject x permutation x voxel steps'.format(cost=cost)
+    print '    ({perms} permutations, {voxels} skeleton voxels -- change with --perms and --voxels)'.format(
+                perms=n_perms, voxels=n_voxels)
 
 #------------------------------------------------
 ### READ IN ARGUMENTS ###
 #------------------------------------------------
+# Anything that starts with -- is an option, everything else
+# is one of the input arguments
+# The options that take a value can be given as --jobs=4 or --jobs 4
+args = sys.argv[1:]
+for name in [ '--jobs', '--perms', '--voxels', '--merge', '--min-subjects', '--max-cond' ]:
+    while name in args and args.index(name) + 1 < len(args):
+        i = args.index(name)
+        args[i:i+2] = [ name + '=' + args[i+1] ]
+options = [ arg for arg in args if arg.startswith('--') ]
+arguments = [ arg for arg in args if not arg.startswith('--') ]
 try:
-    behav_filename= sys.argv[1]
-    cortisol_filename = sys.argv[2]
-    randomise_setup_options_file = sys.argv[3]
-    usable_mri_subs_filename = sys.argv[4]
-    output_dir = sys.argv[5]
+    n_jobs = read_number_option(options, '--jobs', 1)
+    n_perms = read_number_option(options, '--perms', 5000)
+    n_voxels = read_number_option(options, '--voxels', 120000)
+    min_subjects = read_number_option(options, '--min-subjects', 10)
+    max_cond = read_number_option(options, '--max-cond', 30.0, float)
+except ValueError as e:
+    print 'EXITING - ' + str(e)
+    usage()
+    sys.exit()
+plan_only = '--plan' in options
+aux_filenames = [ opt.split('=', 1)[1] for opt in options if opt.startswith('--merge=') ]
+
+try:
+    behav_filename= arguments[0]
+    cortisol_filename = arguments[1]
+    randomise_setup_options_file = arguments[2]
+    usable_mri_subs_filename = arguments[3]
+    output_dir = arguments[4]
 
 # If there aren't enough arguments then exit the script and print 
 # the reason to the screen
@@ -545,13 +1020,18 @@ except IndexError:
 glm_dir = os.path.join(output_dir, 'GLM')
 
 # Set up the data columns
-data = setup_data(behav_filename)
+use_cache = not '--no-cache' in options
+data = setup_data(behav_filename, use_cache)
 
 # Set up the cortisol data and merge with the data array
-data = merge_cort(data, cortisol_filename)
+# (and any other tables you've asked for with --merge)
+try:
+    data = merge_cort(data, cortisol_filename, aux_filenames, use_cache)
+except ValueError as e:
+    print 'EXITING - ' + str(e)
+    sys.exit()
 # Now load in the data
-usable_mri_subs = np.loadtxt(usable_mri_subs_filename, dtype=str)
-usable_mri_subs = np.char.replace(usable_mri_subs, 't1', '').astype(int)
+usable_mri_subs = read_subject_set(usable_mri_subs_filename)
 
 #------------------------------------------------
 ### START CODE ###
@@ -575,52 +1055,46 @@ basically nesting for loops - and this does it for us :)
 '''
 # Note that the range(3) here refers to the 0,1,2 codes
 # for each group splitting
-for perm in it.product(range(3), repeat = len(split_vars)):
-    # Write these names from the dictionary into a names list
-    '''
-    The j counter keeps the split_vars in the right position
-    and calls the appropriate values from the perm iterable
-    and calls the appropriate values from the perm iterable
-    j will always count from 0 to 2 because we've coded the 
-    groups as 0, 1 and 2 in the dictionary
-    '''
-    names = [ group_dict[split_vars[j] + '_' + str(perm[j])] for j in range(len(split_vars)) ]
-
-    # Join the names all together
-    '''
-    '_' is the joining string
-    '''
-    group_dirname = '_'.join(name for name in names)
-    group_dir = os.path.join(glm_dir, group_dirname)
-    
-    # Now create the mask you need for this data
-    # Initally mask is mask_all
-    mask = mask_all
-    for j in range(len(split_vars)):
-        '''
-        This is a pretty kickass awesome line of code that takes
-        advantage of list comprehensions
-        http://docs.python.org/2/tutorial/datastructures.html#list-comprehensions
-        It creates the split mask for each split_var (indexed by j)
-        (eg: split_vars[0] is 'Depressed') where it is equal to the
-        perm value (eg: if perm is (1 2 1) then the perm value for
-        'Depressed' (split_vars[0]) would be perm[0] --> 1)
-        So eg: mask asks where Depressed == 1
-        If the perm var is 2 it just keeps mask_all because 2 is used
-        to code "Ignore that measure for splitting"
-        '''
-        split_mask = np.array(data [split_vars[j]]==perm[j] if perm[j] < 2 else mask_all)
-        mask = mask * split_mask
-    
-    # Don't do anything if the mask is empty
-    if mask.any():
-        # Create the correlation design files
-        create_correlations(group_dir, mask, data, subs_array)
-        
-        # If you have two groups within this group then create t-tests
-        if 2 in list(perm):
-            perm_list = list(perm)
-            create_ttests(perm_list, group_dir, mask, data, subs_array)
+perms = list(it.product(range(3), repeat = len(split_vars)))
+
+# The worker processes have to be forked from this one (they pick up
+# the data and your options from it) but there's no fork on Windows
+# and there the workers would run this whole script again.
+# So on Windows the groups are always done one after another.
+if n_jobs > 1 and not hasattr(os, 'fork'):
+    print 'Can\'t run more than one job at a time on this computer - running one group after another'
+    n_jobs = 1
+
+if n_jobs > 1:
+    # Each group writes into its own directory so they can all be
+    # run at the same time. The worker processes are forked from this
+    # one so they share the data (read only) rather than copying it.
+    # Make the GLM directory first so the workers don't fight over it.
+    if not plan_only:
+        mcf.KW_mkdirs(glm_dir)
+    pool = multiprocessing.Pool(n_jobs)
+    group_designs = pool.map(create_group, perms, chunksize = 1)
+    pool.close()
+    pool.join()
+else:
+    group_designs = [ create_group(perm) for perm in perms ]
+
+# Find the designs that are broken (or close to it)
+problems = check_designs(group_designs, min_subjects, max_cond)
+
+if plan_only:
+    print_plan(group_designs, problems, n_perms, n_voxels)
+else:
+    # Write out each different design that hasn't been pruned once
+    # and the manifest that says which one to use for all the others
+    # and then the report of what was pruned and flagged
+    mcf.KW_mkdirs(output_dir)
+    write_designs(group_designs, os.path.join(output_dir, 'design_manifest.txt'), problems)
+    report_filename = os.path.join(output_dir, 'design_pruning.txt')
+    write_pruning_report(group_designs, problems, report_filename)
+    n_pruned = len([ 1 for action, reason, rank, cond in problems.values() if action == 'pruned' ])
+    print 'Pruned {pruned} designs and flagged {flagged} (see {report})'.format(
+                pruned=n_pruned, flagged=len(problems) - n_pruned, report=report_filename)
 
 '''
 I'd like to include a clean up here so that folders that aren't necessary are deleted
@@ -17,6 +17,17 @@
 #               BUGS:
 #
 #              NOTES:  Data is demeaned, unless there is the word 'TTest'
+#
+#                      RandomiseSetup.py only writes out one copy of designs
+#                      that are exactly the same, so randomise only runs
+#                      once for each of them. The design_manifest.txt file
+#                      in <TBSS_DIR> lists the model for every design and
+#                      at the end the results for the copies are linked
+#                      to the results for their model.
+#
+#                      Designs in different groups can have the same test
+#                      name (but different subjects) so the results for
+#                      each design go in RESULTS/<group>/<test_name>.
 #                      
 #                      The subject id structure is specific to the study, so
 #                      here each <subid> is a 4 digit number followed by t and
@@ -66,6 +77,7 @@ if [ $# -ne 2 ]; then
 	echo "There should also be a SKELETON_DATA folder within the TBSS_dir"
     echo "And additionally the mask from PRE_PROCESSING/stats"
 	echo "The results will go into a RESULTS folder within the TBSS_dir"
+    echo "(with a folder for each group)"
 	echo -e "\teg: ./RandomiseAnalyses.sh /home/kw401/MRIMPACT/ANALYSES/TBSS_120214 500"
 	exit
 fi
@@ -81,6 +93,11 @@ fi
 for group in `ls -d ${tbss_dir}/GLM/*`; do
     group_name=`basename ${group}`
     echo ${group_name}
+    # Skip groups where all the designs are copies of ones in other groups
+    if [[ -z `ls ${group}/*mat 2> /dev/null` ]]; then
+        echo "No designs to run - they've all been run in other groups"
+        continue
+    fi
     subs_file=${group}/subs_t1
     if [[ ! -f ${subs_file} ]]; then
         echo "Subs file doesn't exist - check!"
@@ -134,10 +151,10 @@ for group in `ls -d ${tbss_dir}/GLM/*`; do
         test_name=(`basename ${mat_file} .mat`)
         con_file=${mat_file%????}.con
     
-        test_dir=$tbss_dir/RESULTS/${test_name}/
+        test_dir=$tbss_dir/RESULTS/${group_name}/${test_name}/
     
         # Make logs dir in ouput dir
-        mkdir -p ${test_dir}/LOGS/${group_name}
+        mkdir -p ${test_dir}/LOGS
     
         # Loop through the different measures
         for measure in FA L1 L23 MD MO; do
@@ -164,7 +181,7 @@ for group in `ls -d ${tbss_dir}/GLM/*`; do
                             -d ${mat_file} \
                             -t ${con_file} \
                             -n ${n_perms} \
-                            --T2 -x ${demean} >> ${test_dir}/LOGS/${group_name}/${measure}_${n_perms}.log
+                            --T2 -x ${demean} >> ${test_dir}/LOGS/${measure}_${n_perms}.log
                     rm ${outfile}_alreadystarted
                 else
                     echo "Randomise for ${test_name} ${measure} is already in progress"
@@ -179,6 +196,22 @@ for group in `ls -d ${tbss_dir}/GLM/*`; do
 
 done # Close group file loop
 
+# Link the results for designs that are copies of another design
+# (in another group or with a different test name) to the results
+# for that design
+manifest_file=${tbss_dir}/design_manifest.txt
+if [[ -f ${manifest_file} ]]; then
+    tail -n +2 ${manifest_file} | while read group_name test_name model_group_name model_test_name digest; do
+        results_dir=${tbss_dir}/RESULTS/${group_name}/${test_name}
+        model_results_dir=${tbss_dir}/RESULTS/${model_group_name}/${model_test_name}
+        if [[ ${results_dir} != ${model_results_dir} && ! -e ${results_dir} ]]; then
+            echo "Linking results for ${group_name}/${test_name} to ${model_group_name}/${model_test_name}"
+            mkdir -p ${tbss_dir}/RESULTS/${group_name}
+            ln -s ${model_results_dir} ${results_dir}
+        fi
+    done
+fi
+
 #=============================================================================
 # Interesting story of the day:
 #    Today is Earth Day and the google doodle is really cute.
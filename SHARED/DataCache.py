@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Name: DataCache.py
+
+Created by Kirstie Whitaker
+Contact information: kw401@cam.ac.uk
+
+Saves the data that Cortisol_PreProcessing.py and RandomiseSetup.py
+read in (and clean) as .npy files in a .cache directory next to
+the data file, so that next time it can just be memory mapped
+rather than read and cleaned all over again.
+
+Both scripts add this directory to their path, eg:
+    import DataCache as dc
+    data = dc.load_cached_data('BehavData.txt', read_tab_file)
+"""
+#====================================================================
+# IMPORTS
+#====================================================================
+import os
+import re
+import hashlib
+import inspect
+import numpy as np
+#====================================================================
+
+#====================================================================
+# FUNCTIONS
+#====================================================================
+def hash_file(filename, code_functions):
+    '''
+    Create a key for the cache from the contents of the file and
+    the source code of the functions that read and clean it
+    (so if you change the cleaning code the cache is ignored)
+    '''
+    sha = hashlib.sha1()
+    for function in code_functions:
+        sha.update(inspect.getsource(function))
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            sha.update(block)
+    return sha.hexdigest()
+#--------------------------------------------------------------------
+
+def remove_stale_cache(cache_filename):
+    '''
+    Delete the other cache files for the same data file
+    (<name>.<key>.npy with a different key). They're from an older
+    version of the file (or of the code that reads it) so they'll
+    never be read again and would just fill up the .cache directory.
+    '''
+    cache_dir, cache_name = os.path.split(cache_filename)
+    name = cache_name.rsplit('.', 2)[0]
+    stale = re.compile(re.escape(name) + r'\.[0-9a-f]{40}\.npy$')
+    for old_name in os.listdir(cache_dir):
+        if stale.match(old_name) and not old_name == cache_name:
+            try:
+                os.remove(os.path.join(cache_dir, old_name))
+            except OSError:
+                pass
+#--------------------------------------------------------------------
+
+def load_cached_data(data_filename, read_function, code_functions=None,
+                        use_cache=True, write_cache=True):
+    '''
+    Return the data for data_filename from the cache in a .cache
+    directory next to the file if it's there, otherwise read it
+    with read_function and save it to the cache for next time
+    (and get rid of the old cache files for data_filename).
+    The cached data is a .npy file that's memory mapped (read only)
+    so it doesn't even need to be copied into memory until you use it.
+    INPUT:      data_filename
+                read_function (takes the filename and returns the data)
+                code_functions (list of the functions that read and
+                                    clean the data, default is
+                                    just read_function)
+                use_cache (if False just read the file)
+                write_cache (if False don't save a new cache file)
+    RETURNS:    data (structured array)
+    '''
+    if not use_cache:
+        return read_function(data_filename)
+
+    if code_functions is None:
+        code_functions = [ read_function ]
+
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(data_filename)), '.cache')
+    key = hash_file(data_filename, code_functions)
+    cache_filename = os.path.join(cache_dir,
+                            '{name}.{key}.npy'.format(name=os.path.basename(data_filename), key=key))
+
+    if os.path.isfile(cache_filename):
+        return np.load(cache_filename, mmap_mode='r')
+
+    data = read_function(data_filename)
+
+    if not write_cache:
+        return data
+
+    # Save to a temporary file and then move it into place so nobody
+    # ever reads half a cache file. If you can't write there it
+    # doesn't matter, you just won't have a cache.
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        temp_filename = cache_filename + '.{pid}.tmp'.format(pid=os.getpid())
+        with open(temp_filename, 'wb') as f:
+            np.save(f, data)
+        os.rename(temp_filename, cache_filename)
+        remove_stale_cache(cache_filename)
+    except (IOError, OSError):
+        print 'Couldn\'t write the cache file {cache}'.format(cache=cache_filename)
+
+    return data
+#====================================================================
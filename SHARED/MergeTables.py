@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Name: MergeTables.py
+
+Created by Kirstie Whitaker
+Contact information: kw401@cam.ac.uk
+
+Joins tables of subject data (eg: cortisol, questionnaires or
+scanner QC) together by SubID. RandomiseSetup.py uses it to add the
+cortisol measures (and anything you give it with --merge) to the
+behavioural data.
+
+    import MergeTables as mt
+    data, table_names = mt.merge_tables(data, [ (cort_data, cort_names, 'cort') ])
+"""
+#====================================================================
+# IMPORTS
+#====================================================================
+import numpy as np
+#====================================================================
+
+#====================================================================
+# FUNCTIONS
+#====================================================================
+def define_fill(dtype, fill_value):
+    '''
+    The dtype a column needs (and the value to use) for subjects who
+    aren't in its table, so that the missing values can't be mistaken
+    for real ones:
+        strings get '' (999 would be cut down to fit, eg: '9')
+        bools and small ints are made big enough to hold fill_value
+            (eg: a bool column becomes 0s, 1s and 999s)
+        everything else just gets fill_value
+    INPUT:      dtype (of the column in its own table)
+                fill_value (eg: 999)
+    RETURNS:    dtype, fill
+    '''
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'SU':
+        return dtype, ''
+    if dtype.kind in 'biu':
+        return np.promote_types(dtype, np.min_scalar_type(fill_value)), fill_value
+    return dtype, fill_value
+#--------------------------------------------------------------------
+
+def merge_tables(data, tables, fill_value=999):
+    '''
+    Join the columns from other tables onto data by SubID.
+    Each table is indexed by SubID (in a dictionary) so finding
+    each subject is just a look up, and the merged array is made
+    in one go with the missing values already filled in.
+    The rows come out sorted by SubID (like nprf.join_by used to
+    do it) so the subs files are in the same order as before.
+
+    If a column is already in data (or an earlier table) then the
+    one from this table gets the table's label on the end
+    (eg: Age_QC) rather than overwriting it.
+
+    Inputs:
+        data            Rec array with a SubID column
+        tables          List of (aux_data, names, label) where aux_data
+                            is a rec array with a SubID column, names
+                            are the columns you want from it and label
+                            is a short name for the table
+        fill_value      Value for subjects who aren't in a table
+                            (string columns get '' instead and bool or
+                            small int columns are made big enough
+                            to hold it, see define_fill)
+
+    Output:
+        data            Rec array with all the columns
+        table_names     List of the names each table's columns
+                            ended up with in data
+    '''
+    order = np.argsort(data['SubID'], kind='mergesort')
+    sub_ids = data['SubID'][order].tolist()
+
+    # SubID goes first (again like nprf.join_by)
+    base_names = [ 'SubID' ] + [ name for name in data.dtype.names if not name == 'SubID' ]
+    fields = [ (name, data.dtype[name]) for name in base_names ]
+    used_names = set(base_names)
+    table_rows = []
+    table_names = []
+    for aux_data, names, label in tables:
+        # Find the row for each subject in this table
+        # (if a subject is in there twice the first one wins)
+        index = dict()
+        for i, sub_id in enumerate(aux_data['SubID'].tolist()):
+            index.setdefault(sub_id, i)
+        rows = np.array([ index.get(sub_id, -1) for sub_id in sub_ids ], dtype=int)
+        table_rows.append(rows)
+
+        # Rename any columns we've already got
+        new_names = []
+        for name in names:
+            new_name = name
+            if new_name in used_names:
+                new_name = name + '_' + label
+            i = 2
+            while new_name in used_names:
+                new_name = name + '_' + label + '_' + str(i)
+                i += 1
+            if not new_name == name:
+                print 'Column {name} from {label} is already in the data so it\'s called {new_name}'.format(
+                            name=name, label=label, new_name=new_name)
+            used_names.add(new_name)
+            new_names.append(new_name)
+            fields.append((new_name, define_fill(aux_data.dtype[name], fill_value)[0]))
+        table_names.append(new_names)
+
+    merged = np.empty(len(sub_ids), dtype=fields)
+    for name in base_names:
+        merged[name] = data[name][order]
+
+    for (aux_data, names, label), rows, new_names in zip(tables, table_rows, table_names):
+        found = rows >= 0
+        for name, new_name in zip(names, new_names):
+            merged[new_name] = define_fill(aux_data.dtype[name], fill_value)[1]
+            merged[new_name][found] = aux_data[name][rows[found]]
+
+    return merged.view(np.recarray), table_names
+#====================================================================
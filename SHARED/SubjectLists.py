@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Name: SubjectLists.py
+
+Created by Kirstie Whitaker
+Contact information: kw401@cam.ac.uk
+
+Reads the lists of subject IDs that both Cortisol_PreProcessing.py
+(include and exclude lists for filter_subs) and RandomiseSetup.py
+(the usable mri subjects) use so that they always read them in
+exactly the same way.
+
+Both scripts add this directory to their path, eg:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        os.pardir, 'SHARED'))
+    import SubjectLists as sl
+    subject_set = sl.read_subject_set('MRIMPACT_subs.txt')
+"""
+#====================================================================
+# IMPORTS
+#====================================================================
+import os
+#====================================================================
+
+#====================================================================
+# Subject lists that have already been read in (see read_subject_set)
+# filename: (time the file was changed, set of subject IDs)
+subject_set_cache = dict()
+#====================================================================
+
+#====================================================================
+# FUNCTIONS
+#====================================================================
+def read_subject_id(sub_id):
+    '''
+    Turn one subject ID from a list into an int, taking off the
+    session number if it's there (eg: 1234t1 --> 1234)
+    '''
+    return int(sub_id.split('t')[0])
+#--------------------------------------------------------------------
+
+def read_subject_set(sublist_filename):
+    '''
+    Read a list of subject IDs (whitespace separated, # for
+    comments, with or without the session number on the end)
+    into a set so that each subject can be looked up straight
+    away. Each file is only read once (unless it's changed since)
+    however many times you ask for it.
+    INPUT:      sublist_filename (file with a list of subject IDs)
+    RETURNS:    subject_set (frozenset of subject IDs as ints)
+    '''
+    if not os.path.isfile(sublist_filename):
+        raise IOError('Can\'t find the subject list {filename}'.format(filename=sublist_filename))
+
+    key = os.path.abspath(sublist_filename)
+    mtime = os.path.getmtime(sublist_filename)
+    if key in subject_set_cache and subject_set_cache[key][0] == mtime:
+        return subject_set_cache[key][1]
+
+    with open(sublist_filename) as f:
+        subject_set = frozenset([ read_subject_id(sub_id) for line in f
+                                    for sub_id in line.split('#')[0].split() ])
+
+    subject_set_cache[key] = (mtime, subject_set)
+
+    return subject_set
+#====================================================================
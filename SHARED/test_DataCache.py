@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Name: test_DataCache.py
+
+Checks that load_cached_data reads the data from the cache once
+it's been saved, and that saving a new cache file for a data file
+gets rid of the old ones.
+
+    python -m unittest discover -s SHARED -p 'test_*.py'
+"""
+#====================================================================
+# IMPORTS
+#====================================================================
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from DataCache import load_cached_data
+#====================================================================
+
+def read_tab_file(filename):
+    return np.genfromtxt(filename, dtype=None, names=True, delimiter='\t')
+
+class TestDataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.data_dir, '.cache')
+        self.data_filename = os.path.join(self.data_dir, 'data.txt')
+        self.write_data('SubID\tAge\n1\t10\n2\t20\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def write_data(self, text):
+        with open(self.data_filename, 'w') as f:
+            f.write(text)
+
+    def test_reads_from_cache(self):
+        load_cached_data(self.data_filename, read_tab_file)
+        data = load_cached_data(self.data_filename, read_tab_file)
+        self.assertTrue(isinstance(data, np.memmap))
+        self.assertEqual(data['Age'].tolist(), [ 10, 20 ])
+
+    def test_removes_stale_cache(self):
+        load_cached_data(self.data_filename, read_tab_file)
+        # Another file whose name starts the same shouldn't be touched
+        other_filename = os.path.join(self.cache_dir, 'data.txt.old.' + 'a' * 40 + '.npy')
+        open(other_filename, 'w').close()
+
+        self.write_data('SubID\tAge\n1\t11\n2\t21\n')
+        data = load_cached_data(self.data_filename, read_tab_file)
+        self.assertEqual(data['Age'].tolist(), [ 11, 21 ])
+
+        cache_names = sorted(os.listdir(self.cache_dir))
+        self.assertEqual(len(cache_names), 2)
+        self.assertTrue(os.path.basename(other_filename) in cache_names)
+
+    def test_no_write_cache(self):
+        load_cached_data(self.data_filename, read_tab_file, write_cache=False)
+        self.assertFalse(os.path.isdir(self.cache_dir))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Name: test_MergeTables.py
+
+Checks that merge_tables fills in the subjects who aren't in a
+table with values that can't be mistaken for real ones, whatever
+the type of the column.
+
+    python -m unittest discover -s SHARED -p 'test_*.py'
+"""
+#====================================================================
+# IMPORTS
+#====================================================================
+import unittest
+import numpy as np
+from MergeTables import merge_tables
+#====================================================================
+
+class TestMergeTables(unittest.TestCase):
+
+    def setUp(self):
+        self.data = np.array([ (3, 30.0), (1, 10.0), (2, 20.0) ],
+                                dtype=[ ('SubID', int), ('Age', float) ]).view(np.recarray)
+        # Subject 2 isn't in the aux table
+        self.aux_data = np.array([ (1, 'good', True, 5, 1.5),
+                                   (3, 'bad', False, -5, 3.5) ],
+                                dtype=[ ('SubID', int), ('Note', 'S4'), ('Motion', bool),
+                                        ('Score', np.int8), ('Age', float) ]).view(np.recarray)
+        self.names = [ 'Note', 'Motion', 'Score', 'Age' ]
+
+    def merge(self):
+        return merge_tables(self.data, [ (self.aux_data, self.names, 'qc') ])
+
+    def test_sorted_by_subid(self):
+        merged, table_names = self.merge()
+        self.assertEqual(merged['SubID'].tolist(), [ 1, 2, 3 ])
+        self.assertEqual(merged['Age'].tolist(), [ 10.0, 20.0, 30.0 ])
+
+    def test_string_column(self):
+        merged, table_names = self.merge()
+        self.assertEqual(merged['Note'].tolist(), [ 'good', '', 'bad' ])
+
+    def test_bool_column(self):
+        merged, table_names = self.merge()
+        self.assertEqual(merged['Motion'].tolist(), [ 1, 999, 0 ])
+
+    def test_small_int_column(self):
+        merged, table_names = self.merge()
+        self.assertEqual(merged['Score'].tolist(), [ 5, 999, -5 ])
+
+    def test_renamed_column(self):
+        merged, table_names = self.merge()
+        self.assertEqual(table_names, [ [ 'Note', 'Motion', 'Score', 'Age_qc' ] ])
+        self.assertEqual(merged['Age_qc'].tolist(), [ 1.5, 999.0, 3.5 ])
+
+if __name__ == '__main__':
+    unittest.main()